@@ -1,35 +1,41 @@
 import asyncio
+import collections
+import functools
 import re
+import time
 
 from discord.ext import commands
 from validator_collection import checkers
 
 import ytdl
 import gdrive
-from main import config
+import library
+import cache
+import transcode
+import ffmpeg_pool
+import download_service
+import thumbnails
+from main import INFO, config
 
-async def parse_search(ctx, search: str, loop: asyncio.BaseEventLoop = None):
+async def parse_search(ctx, search: str, backends, loop: asyncio.BaseEventLoop = None):
 
-    loop = loop or asyncio.get_event_loop()
-    source_type = "GDrive"
     if checkers.is_url(search):
         return search
 
-    gdrive_folder_id = config['gdrive_id']
-    if not gdrive_folder_id:
+    if backends.library is None:
         return search
 
-    source_init = Source(ctx, source_type=source_type, loop=loop)
     try:
-        sources = await source_init.get_playlist(gdrive_folder_id, include_name=True)
-    except SourceError as e:
-        await ctx.send('An error occurred while processing this request: {}'.format(str(e)))
+        # A cold index can take many listing pages, searching YouTube beats outwaiting the VoiceState
+        await asyncio.wait_for(backends.library.ready.wait(), config.get('library_wait', 1.0))
+    except asyncio.TimeoutError:
+        INFO("Library index isn't ready yet, searching YouTube instead")
         return search
 
-    for each_source in sources:
-        if search.lower() in each_source['name'].lower():
-            search = f"https://drive.google.com/file/d/{each_source['id']}/view"
-            break
+    matches = backends.library.search(search)
+    if matches:
+        file_id, _ = matches[0]
+        search = f"https://drive.google.com/file/d/{file_id}/view"
 
     return search
 
@@ -61,14 +67,41 @@ class DataClass:
     def __init__(self, **info):
         self.__dict__.update(info)
 
+class Playlist:
+    """A fetched playlist.
+    Iterating it yields its entries as {"id", "name"} dicts, Source.iter_placeholders turns them into tracks one at a time.
+    """
+    __slots__ = ('title', 'song_num', 'entries')
+
+    def __init__(self, title: str, song_num: int, entries: list):
+
+        self.title = title
+        self.song_num = song_num
+        self.entries = entries
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return self.song_num
+
 class MusicInfo:
+    """A queued track.
+    Starts out as a placeholder holding only what the playlist listing gave us,
+    the full metadata is fetched by resolve() shortly before it is needed.
+    """
+    __slots__ = (
+        'requester', 'channel', 'bot', 'source_type', 'data', 'backends',
+        'resolved', 'resolving', 'downloaded', 'downloading', 'volume'
+    )
+
     def __init__(
         self,
         ctx: commands.Context,
         source_type: str,
         data: dict,
-        gdrive: gdrive.GDriveSource,
-        youtube: ytdl.YTDLSource
+        backends,
+        resolved: bool = True
     ):
 
         self.requester = ctx.author
@@ -76,17 +109,80 @@ class MusicInfo:
         self.bot = ctx.bot
         self.source_type = source_type
         self.data = data
-        self.gdrive = gdrive
-        self.youtube = youtube
-
-    async def ready_download(self):
+        self.backends = backends
+        self.resolved = resolved
+        self.resolving = None
+        self.downloaded = False
+        self.downloading = None
+        self.volume = None
+
+    def start_resolve(self):
+        if not self.resolved and self.resolving is None:
+            self.resolving = self.bot.loop.create_task(self.fetch_data())
+            self.resolving.add_done_callback(self.resolve_done)
+        return self.resolving
+
+    def resolve_done(self, task: asyncio.Task):
+        # Retrieving the exception here keeps failed lookaheads quiet, resolve() raises it again
+        if task.cancelled() or task.exception() is not None:
+            self.resolving = None
+
+    async def resolve(self):
+        if self.resolved:
+            return
+        await asyncio.shield(self.start_resolve())
+
+    async def fetch_data(self):
 
         if self.source_type == "GDrive":
-            self.data = await self.gdrive.ready_download(self.data)
+            info = await self.backends.gdrive.create_source(search=self.data.search)
         elif self.source_type == "YouTube":
-            self.data = await self.youtube.ready_download(self.data)
+            info = await self.backends.youtube.create_source(search=self.data.search)
+
+        if info is None:
+            raise SourceError('Couldn\'t fetch `{}`'.format(self.data.search))
+
+        self.data = DataClass(**info)
+        self.resolved = True
+        self.resolving = None
+
+    def start_download(self):
+        if not self.downloaded and self.downloading is None:
+            self.downloading = self.bot.loop.create_task(self.fetch_file())
+            self.downloading.add_done_callback(self.download_done)
+        return self.downloading
+
+    def download_done(self, task: asyncio.Task):
+        if task.cancelled() or task.exception() is not None:
+            self.downloading = None
+
+    async def ready_download(self):
+        if self.downloaded:
+            return
+        await asyncio.shield(self.start_download())
+
+    async def fetch_file(self):
+
+        await self.resolve()
+        if self.backends.load_opus(self.data):
+            if self.source_type == "GDrive":
+                await self.backends.gdrive.ready_thumbnail(self.data)
+        else:
+            self.data = await self.backends.fetch(self.source_type, self.data)
 
         self.data.duration = self.parse_duration(self.data.duration)
+        self.downloaded = True
+        self.downloading = None
+
+    async def stream_source(self):
+        """Returns what to stream the track from and the ffmpeg before_options, or None if it can't be streamed.
+        The input is either a url or an async iterator of the track's bytes.
+        """
+
+        if self.source_type == "GDrive":
+            return await self.backends.gdrive.stream_source(self.data)
+        elif self.source_type == "YouTube":
+            return self.backends.youtube.stream_source(self.data)
 
     @staticmethod
     def parse_duration(duration: int):
@@ -117,42 +213,252 @@ class MusicInfo:
 class SourceError(Exception):
     pass
 
+class Backends:
+    """Source backends shared by every guild.
+    Created once when the music cog loads and passed to every Source and MusicInfo.
+    """
+
+    def __init__(self, loop: asyncio.BaseEventLoop = None, download_only: bool = False):
+
+        self.loop = loop or asyncio.get_event_loop()
+        self.audio_cache = cache.CacheManager(
+            "audio_cache",
+            max_bytes=config.get('audio_cache_max_mb', 10240) * 1024 * 1024,
+            max_entries=config.get('audio_cache_max_files', 5000)
+        )
+        self.image_cache = cache.CacheManager(
+            "image_cache",
+            max_bytes=config.get('image_cache_max_mb', 256) * 1024 * 1024,
+            max_entries=config.get('image_cache_max_files', 5000)
+        )
+        self.metadata = cache.MetadataCache(
+            self.audio_cache.db,
+            ttl=config.get('metadata_ttl_hours', 168) * 60 * 60,
+            negative_ttl=config.get('metadata_negative_ttl_minutes', 60) * 60
+        )
+        self.thumbnails = thumbnails.ThumbnailCache(
+            self.image_cache,
+            size=config.get('thumbnail_size', 320),
+            memory_bytes=config.get('thumbnail_memory_mb', 16) * 1024 * 1024,
+            loop=self.loop
+        )
+        self.gdrive = gdrive.GDriveSource(self.audio_cache, self.thumbnails)
+        self.youtube = ytdl.YTDLSource(self.loop, self.audio_cache, self.metadata)
+
+        self.library = None
+        if config['gdrive_id'] and not download_only:
+            self.library = library.LibraryIndex(
+                self.gdrive,
+                config['gdrive_id'],
+                refresh_interval=config.get('library_refresh_interval', 600),
+                loop=self.loop
+            )
+            self.library.start()
+
+        self.opus_bitrate = config.get('opus_bitrate', 128)
+        # expected_filename -> transcode in progress, shared by every play of the track
+        self.ingesting = {}
+
+        self.ffmpeg_pool = ffmpeg_pool.FFmpegPool(
+            config.get('ffmpeg_pool_size', 2),
+            max_idle=config.get('ffmpeg_pool_max_idle', 600),
+            loop=self.loop
+        )
+        if not download_only:
+            self.ffmpeg_pool.start()
+
+        self.download_service = None
+        if config.get('download_service', False) and not download_only:
+            self.download_service = download_service.DownloadClient(
+                config.get('download_service_port', 8765),
+                spawn=config.get('download_service_spawn', True),
+                loop=self.loop
+            )
+
+        # Shared by every guild so background prefetching can't saturate the connection
+        self.prefetch_slots = asyncio.Semaphore(config.get('prefetch_concurrency', 1))
+
+        # (source_type, search) -> (fetched_time, task), so callers asking for the same playlist share a fetch
+        self.playlists = {}
+        self.playlist_ttl = config.get('playlist_cache_seconds', 60)
+
+    async def get_playlist(self, source_type: str, search: str):
+        """Fetches a playlist once and hands the same result to everyone asking for it within playlist_ttl"""
+        now = time.time()
+        for key, (fetched_time, task) in list(self.playlists.items()):
+            if task.done() and now - fetched_time >= self.playlist_ttl:
+                del self.playlists[key]
+
+        key = (source_type, search)
+        if key not in self.playlists:
+            backend = self.gdrive if source_type == "GDrive" else self.youtube
+            task = self.loop.create_task(backend.fetch_playlist(search=search))
+            task.add_done_callback(functools.partial(self.playlist_done, key))
+            self.playlists[key] = (now, task)
+
+        _, task = self.playlists[key]
+        return Playlist(**await asyncio.shield(task))
+
+    def playlist_done(self, key: tuple, task: asyncio.Task):
+        # Failures aren't cached, the next caller tries again
+        if task.cancelled() or task.exception() is not None:
+            if self.playlists.get(key, (None, None))[1] is task:
+                del self.playlists[key]
+
+    def load_opus(self, data: DataClass):
+        """Points data at the pre-encoded opus copy of the track if there is one, filling in the tags from the index"""
+        entry = self.audio_cache.lookup(transcode.opus_filename(data.expected_filename))
+        if entry is None:
+            return False
+
+        data.expected_filename = entry['name']
+        data.artist = entry['artist'] or "Unknown"
+        data.duration = entry['duration'] or 0
+        return True
+
+    async def fetch(self, source_type: str, data: DataClass):
+        """Gets a track into the cache through the download service, or in this process if there is none"""
+        if self.download_service is not None:
+            try:
+                info = await self.download_service.fetch(source_type, data, download_service.log_progress(data))
+            except download_service.ServiceUnavailable as e:
+                INFO(f"Downloading {data.title} in process: {e}")
+            else:
+                data = DataClass(**info)
+                if data.image_filename:
+                    await self.thumbnails.load(data.image_filename)
+                return data
+
+        return await self.download(source_type, data, download_service.log_progress(data))
+
+    async def download(self, source_type: str, data: DataClass, progress=None):
+        """Downloads a track into the cache and pre-encodes it to opus.
+        progress(downloaded_bytes, total_bytes) is called on the event loop while the download runs.
+        """
+        if source_type == "GDrive":
+            data = await self.gdrive.ready_download(data, progress)
+        elif source_type == "YouTube":
+            data = await self.youtube.ready_download(data, progress)
+        await self.ingest(data)
+        return data
+
+    async def ingest(self, data: DataClass):
+        """Transcodes a freshly downloaded track to opus once, replacing the original in the cache.
+        Concurrent plays of the same track share one transcode.
+        """
+        if data.expected_filename.endswith(".opus"):
+            return
+
+        opus_filename = transcode.opus_filename(data.expected_filename)
+        if self.audio_cache.lookup(opus_filename) is not None:
+            # Another play of the track got it transcoded first
+            data.expected_filename = opus_filename
+            return
+
+        task = self.ingesting.get(data.expected_filename)
+        if task is None:
+            task = self.loop.create_task(self.transcode_file(data))
+            task.add_done_callback(functools.partial(self.ingest_done, data.expected_filename))
+            self.ingesting[data.expected_filename] = task
+        if await asyncio.shield(task):
+            data.expected_filename = opus_filename
+
+    def ingest_done(self, filename: str, task: asyncio.Task):
+        if self.ingesting.get(filename) is task:
+            del self.ingesting[filename]
+
+    async def transcode_file(self, data: DataClass):
+        opus_filename = transcode.opus_filename(data.expected_filename)
+        transcoded = await transcode.to_opus(
+            self.audio_cache.path(data.expected_filename),
+            self.audio_cache.path(opus_filename),
+            bitrate=self.opus_bitrate
+        )
+        if not transcoded:
+            return False
+
+        partial = functools.partial(cache.file_checksum, self.audio_cache.path(opus_filename))
+        checksum = await self.loop.run_in_executor(None, partial)
+        self.audio_cache.add(
+            opus_filename,
+            title=data.title,
+            artist=data.artist,
+            duration=data.duration,
+            checksum=checksum
+        )
+        self.audio_cache.discard(data.expected_filename)
+        return True
+
 class Source:
 
-    def __init__(self, ctx: commands.Context, source_type: str, loop: asyncio.BaseEventLoop = None):
+    def __init__(self, ctx: commands.Context, source_type: str, backends: Backends, loop: asyncio.BaseEventLoop = None):
 
         self.ctx = ctx
         self.loop = loop or asyncio.get_event_loop()
         self.source_type = source_type
-        self.gdrive = gdrive.GDriveSource()
-        self.youtube = ytdl.YTDLSource(self.loop)
+        self.backends = backends
+        self.gdrive = backends.gdrive
+        self.youtube = backends.youtube
 
     async def create_source(self, search: str):
 
+        source = self.create_placeholder(search)
+        await source.resolve()
+
+        return source
+
+    def create_placeholder(self, search: str, name: str = None):
+
         if self.source_type == "GDrive":
-            info = await self.gdrive.create_source(search=search)
+            info = self.gdrive.placeholder_info(search=search, name=name)
         elif self.source_type == "YouTube":
-            info = await self.youtube.create_source(search=search)
+            info = self.youtube.placeholder_info(search=search, name=name)
 
         data = DataClass(**info)
 
-        return MusicInfo(self.ctx, self.source_type, data, self.gdrive, self.youtube)
+        return MusicInfo(self.ctx, self.source_type, data, self.backends, resolved=False)
 
-    async def get_playlist_info(self, search: str):
+    async def get_playlist(self, search: str):
 
-        if self.source_type == "GDrive":
-            info = await self.gdrive.get_playlist_info(search=search)
-        elif self.source_type == "YouTube":
-            info = await self.youtube.get_playlist_info(search=search)
+        return await self.backends.get_playlist(self.source_type, search)
 
-        info = DataClass(**info)
-        return info
+    def iter_placeholders(self, playlist: Playlist):
 
-    async def get_playlist(self, search: str, include_name: bool = False):
+        for entry in playlist:
+            yield self.create_placeholder(entry['id'], entry['name'])
 
-        if self.source_type == "GDrive":
-            sources = await self.gdrive.get_playlist(search=search, include_name=include_name)
-        elif self.source_type == "YouTube":
-            sources = await self.youtube.get_playlist(search=search)
+    async def resolve_placeholders(self, sources: list, concurrency: int = 4):
+        """Resolves placeholders with up to `concurrency` lookups in flight.
+        Yields (MusicInfo, the exception raised or None) in playlist order as soon as each is ready.
+        """
+
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def resolve(source):
+            async with semaphore:
+                await source.resolve()
+
+        # Keep a few more tasks than lookups so a slow entry doesn't leave the other slots idle
+        sources = iter(sources)
+        pending = collections.deque()
+        try:
+            while True:
+                while len(pending) < concurrency * 2:
+                    source = next(sources, None)
+                    if source is None:
+                        break
+                    pending.append((source, self.loop.create_task(resolve(source))))
+
+                if not pending:
+                    break
 
-        return sources
+                source, task = pending.popleft()
+                try:
+                    await task
+                except Exception as e:
+                    yield source, e
+                else:
+                    yield source, None
+        finally:
+            for _, task in pending:
+                task.cancel()
@@ -0,0 +1,104 @@
+import asyncio
+import random
+from collections import deque
+
+from discord.ext import commands
+
+import SourceDL
+from main import load_file, INFO
+
+AUTOPLAYLIST = "autoplaylist.txt"
+
+class AutoPlayer:
+    """Endless shuffled stream of tracks from autoplaylist.txt for when the queue runs dry.
+    Folders and playlists are expanded in place, each track comes up once per pass through the list,
+    and the next track is resolved and downloaded ahead of time so it can start as soon as the queue empties.
+    """
+
+    def __init__(self, ctx: commands.Context, backends: SourceDL.Backends, loop: asyncio.BaseEventLoop = None):
+
+        self.ctx = ctx
+        self.backends = backends
+        self.loop = loop or asyncio.get_event_loop()
+
+        # (search, source_type, name), source_type is None for lines of the autoplaylist that still need parsing
+        self.candidates = deque()
+        self.seen = set()
+        self.preparing = None
+
+    def prepare(self):
+        """Starts preparing the next track if it isn't already"""
+        if self.preparing is None:
+            self.preparing = self.loop.create_task(self.next_source())
+        return self.preparing
+
+    async def take(self):
+        """Returns the prepared track, or None if nothing in the autoplaylist could be played"""
+        preparing = self.prepare()
+        try:
+            return await asyncio.shield(preparing)
+        except Exception as e:
+            INFO(f"Failed to prepare an autoplay track: {e}")
+            return None
+        finally:
+            if self.preparing is preparing and preparing.done():
+                self.preparing = None
+
+    def stop(self):
+        if self.preparing is not None:
+            self.preparing.cancel()
+            self.preparing = None
+
+    async def refill(self):
+        links = await self.loop.run_in_executor(None, load_file, AUTOPLAYLIST)
+        links = list(dict.fromkeys(links))
+        random.shuffle(links)
+        self.candidates.extend((link, None, None) for link in links)
+        self.seen.clear()
+
+    async def expand(self, search: str, source_type: str):
+        source_init = SourceDL.Source(self.ctx, source_type=source_type, backends=self.backends, loop=self.loop)
+        try:
+            playlist = await source_init.get_playlist(search)
+        except Exception as e:
+            INFO(f"Failed to expand {search} from autoplaylist: {e}")
+            return
+
+        INFO(f"Adding {playlist.song_num} songs from {search}")
+        entries = [(entry['id'], source_type, entry['name']) for entry in playlist]
+        random.shuffle(entries)
+        self.candidates.extendleft(reversed(entries))
+
+    async def next_source(self):
+        refilled = False
+        while True:
+            if not self.candidates:
+                # One full pass over the list without a playable track means there isn't one
+                if refilled:
+                    return None
+                await self.refill()
+                refilled = True
+                continue
+
+            search, source_type, name = self.candidates.popleft()
+            if source_type is None:
+                search, source_type, playlist = SourceDL.get_type(search)
+                if playlist:
+                    await self.expand(search, source_type)
+                    continue
+
+            if (source_type, search) in self.seen:
+                continue
+            self.seen.add((source_type, search))
+
+            INFO(f"Trying {search} from autoplaylist")
+            source_init = SourceDL.Source(self.ctx, source_type=source_type, backends=self.backends, loop=self.loop)
+            source = source_init.create_placeholder(search, name)
+            try:
+                await source.resolve()
+            except Exception as e:
+                INFO(f"Skipping {search} from autoplaylist: {e}")
+                continue
+
+            source.start_download()
+            return source
@@ -0,0 +1,50 @@
+"""Compares BlockList with the deque SongQueue used to store its items in.
+Run from the bot directory: python bench/bench_blocklist.py [items]
+"""
+import os
+import sys
+import time
+import random
+import itertools
+import collections
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from blocklist import BlockList
+
+def timed(function, indexes: list):
+    start = time.perf_counter()
+    for index in indexes:
+        function(index)
+    return (time.perf_counter() - start) / len(indexes) * 1000
+
+def deque_move(queue: collections.deque, index: int):
+    # Moving an item to the front with the old deque
+    item = queue[index]
+    del queue[index]
+    queue.insert(0, item)
+
+def deque_page(queue: collections.deque, index: int):
+    # The old SongQueue slice
+    return list(itertools.islice(queue, index, index + 10))
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    random.seed(0)
+    # Positions in the middle of the queue are the worst case for the deque
+    indexes = [random.randrange(count // 4, count * 3 // 4) for _ in range(2000)]
+
+    queue = BlockList(range(count))
+    old = collections.deque(range(count))
+
+    print(f"{count} items")
+    for name, new, before in (
+        ("index", lambda index: queue[index], lambda index: old[index]),
+        ("remove", lambda index: (queue.pop(index), queue.append(index)), lambda index: (old.__delitem__(index), old.append(index))),
+        ("move", lambda index: queue.move(index, 0), lambda index: deque_move(old, index)),
+        ("page", lambda index: queue.page(index, index + 10), lambda index: deque_page(old, index))
+    ):
+        print(f"{name:<7} BlockList: {timed(new, indexes):.4f} ms   deque: {timed(before, indexes):.4f} ms")
+
+if __name__ == "__main__":
+    main()
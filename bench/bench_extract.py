@@ -0,0 +1,103 @@
+"""Counts YouTube extractor invocations per play with youtube_dl stubbed out, so it runs offline.
+A play is create_source followed by ready_download, the way a queued track goes from search to cached file.
+Run from the bot directory: python bench/bench_extract.py [plays]
+"""
+import os
+import sys
+import time
+import shutil
+import asyncio
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# music has to be imported before main, SourceDL or ytdl
+import music
+import SourceDL
+import cache
+import ytdl
+
+class FakeYoutubeDL:
+    """Answers extractions with a processed result and downloads by writing a small file to outtmpl"""
+    extractions = 0
+
+    def __init__(self, params: dict = None):
+        self.params = params or {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def extract_info(self, search: str, download: bool = True, **kwargs):
+        FakeYoutubeDL.extractions += 1
+        # Simulates the network round trip of a real extraction
+        time.sleep(0.005)
+        video_id = search.rsplit("=", 1)[-1][:11].ljust(11, "x")
+        info = {
+            "id" : video_id,
+            "title" : f"Track {video_id}",
+            "ext" : "m4a",
+            "extractor" : "youtube",
+            "extractor_key" : "Youtube",
+            "uploader" : "Uploader",
+            "thumbnail" : None,
+            "duration" : 180,
+            "webpage_url" : f"https://www.youtube.com/watch?v={video_id}",
+            "url" : f"https://example.invalid/{video_id}.m4a",
+            "formats" : [{"format_id" : "140"}]
+        }
+        if download:
+            self.process_ie_result(info, download=True)
+        return info
+
+    def process_ie_result(self, info: dict, download: bool = True):
+        with open(self.params['outtmpl'], 'wb') as f:
+            f.write(b"\0" * 1024)
+        return info
+
+async def play(source: ytdl.YTDLSource, search: str):
+    info = await source.create_source(search)
+    await source.ready_download(SourceDL.DataClass(**info))
+    return info
+
+async def run(source: ytdl.YTDLSource, searches: list):
+    calls, extractions = source.extract_calls, FakeYoutubeDL.extractions
+    start = time.perf_counter()
+    for search in searches:
+        await play(source, search)
+    elapsed = (time.perf_counter() - start) / len(searches) * 1000
+    return (source.extract_calls - calls) / len(searches), (FakeYoutubeDL.extractions - extractions) / len(searches), elapsed
+
+def main():
+    plays = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    ytdl.youtube_dl.YoutubeDL = FakeYoutubeDL
+
+    directory = tempfile.mkdtemp(prefix="bench-extract-")
+    try:
+        loop = asyncio.get_event_loop()
+        os.mkdir(os.path.join(directory, "audio"))
+        audio_cache = cache.CacheManager(os.path.join(directory, "audio"), 10 ** 9, 10 ** 6)
+        metadata = cache.MetadataCache(audio_cache.db, ttl=3600, negative_ttl=60)
+        source = ytdl.YTDLSource(loop, audio_cache, metadata)
+        searches = [f"https://www.youtube.com/watch?v={num:011d}" for num in range(plays)]
+
+        print(f"{plays} plays, extractor calls per play (counted by YTDLSource / by the stub) and time per play")
+        cold = loop.run_until_complete(run(source, searches))
+        print(f"cold:                  {cold[0]:.2f} / {cold[1]:.2f}   {cold[2]:.1f} ms")
+        warm = loop.run_until_complete(run(source, searches))
+        print(f"warm:                  {warm[0]:.2f} / {warm[1]:.2f}   {warm[2]:.1f} ms")
+
+        # Cached info but the files were evicted, so the download has to extract again
+        for search in searches:
+            info = loop.run_until_complete(source.create_source(search))
+            audio_cache.discard(info['expected_filename'])
+        evicted = loop.run_until_complete(run(source, searches))
+        print(f"warm info, no file:    {evicted[0]:.2f} / {evicted[1]:.2f}   {evicted[2]:.1f} ms")
+        audio_cache.db.close()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
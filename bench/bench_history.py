@@ -0,0 +1,49 @@
+"""Compares SongHistory with the list the player used to keep its history in,
+which was scanned by title on every track and grown with insert(0).
+Run from the bot directory: python bench/bench_history.py [distinct tracks]
+"""
+import os
+import sys
+import time
+import random
+from collections import namedtuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# music has to be imported before main or voice
+import music
+from voice import SongHistory
+
+Track = namedtuple('Track', ('track_id', 'title', 'webpage_url'))
+
+def list_add(history: list, track: Track):
+    # The old VoiceState loop: drop an earlier play of the same title, then put the track in front
+    for each_track in history:
+        if track.title == each_track.title:
+            history.remove(each_track)
+    history.insert(0, track)
+
+def timed(function, tracks: list):
+    start = time.perf_counter()
+    for track in tracks:
+        function(track)
+    return (time.perf_counter() - start) / len(tracks) * 1000
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    random.seed(0)
+    library = [Track(("YouTube", str(num)), f"Track {num}", f"https://www.youtube.com/watch?v={num}") for num in range(count)]
+    # Every track once, then replays of random ones
+    plays = library + random.choices(library, k=2000)
+
+    history = SongHistory(count)
+    old = []
+    print(f"{count} distinct tracks, {len(plays)} plays")
+    print(f"add   SongHistory: {timed(lambda track: history.add(*track), plays):.4f} ms   list: {timed(lambda track: list_add(old, track), plays):.4f} ms")
+
+    starts = [random.randrange(0, count - 10) for _ in range(2000)]
+    print(f"page  SongHistory: {timed(lambda start: history.page(start, start + 10), starts):.4f} ms   list: {timed(lambda start: old[start:start + 10], starts):.4f} ms")
+    print(f"first SongHistory: {timed(lambda start: history.page(0, 10), starts):.4f} ms   list: {timed(lambda start: old[0:10], starts):.4f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""Compares LibraryIndex lookups with the linear scan parse_search used to do over the listing.
+Run from the bot directory: python bench/bench_library.py [files]
+"""
+import os
+import sys
+import time
+import random
+import string
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# music has to be imported before main or library
+import music
+import library
+
+WORDS = ["angel", "shotgun", "fire", "flames", "night", "core", "remix", "theme", "live", "acoustic", "love", "dance"]
+
+def make_files(count: int):
+    random.seed(0)
+    files = []
+    for num in range(count):
+        words = random.sample(WORDS, 3) + ["".join(random.choices(string.ascii_lowercase, k=6))]
+        files.append({"id" : str(num), "name" : " ".join(words).title() + ".mp3"})
+    return files
+
+def linear_scan(files: list, search: str):
+    for each_file in files:
+        if search.lower() in each_file['name'].lower():
+            return each_file['id'], each_file['name']
+    return None
+
+def timed(function, queries: list):
+    start = time.perf_counter()
+    for query in queries:
+        function(query)
+    return (time.perf_counter() - start) / len(queries) * 1000
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    files = make_files(count)
+
+    start = time.perf_counter()
+    index = library.LibraryIndex(None, "bench")
+    index.entries, index.tokens, index.trigrams = index.build(files)
+    build_time = time.perf_counter() - start
+
+    # The random last word of a file near the end is the worst case for the scan
+    queries = [files[num]['name'].rsplit(" ", 1)[1][:-4] for num in random.sample(range(count // 2, count), 200)]
+    misses = ["".join(random.choices(string.ascii_lowercase, k=7)) for _ in range(200)]
+
+    print(f"{count} files, index built in {build_time:.2f}s")
+    print(f"index substring lookup: {timed(index.search, queries):.3f} ms")
+    print(f"linear scan lookup:     {timed(lambda query: linear_scan(files, query), queries):.3f} ms")
+    print(f"index miss:             {timed(index.search, misses):.3f} ms")
+    print(f"linear scan miss:       {timed(lambda query: linear_scan(files, query), misses):.3f} ms")
+
+if __name__ == "__main__":
+    main()
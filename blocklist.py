@@ -0,0 +1,136 @@
+import random
+import itertools
+
+BLOCK_SIZE = 512
+
+class BlockList:
+    """List stored as blocks of at most 2 * BLOCK_SIZE items with a Fenwick tree over the block sizes.
+    Finding a position takes O(log n) and inserting or deleting there only shifts one block,
+    so indexing, removing and moving items in huge queues doesn't touch the whole list.
+    """
+
+    def __init__(self, items=()):
+        self.rebuild(list(items))
+
+    def rebuild(self, items: list):
+        self._blocks = [items[i:i + BLOCK_SIZE] for i in range(0, len(items), BLOCK_SIZE)]
+        self._len = len(items)
+        self.build_tree()
+
+    def build_tree(self):
+        size = len(self._blocks)
+        tree = [0] * (size + 1)
+        for num, block in enumerate(self._blocks, start=1):
+            tree[num] += len(block)
+            parent = num + (num & -num)
+            if parent <= size:
+                tree[parent] += tree[num]
+        self._tree = tree
+
+    def update(self, block: int, delta: int):
+        num = block + 1
+        while num < len(self._tree):
+            self._tree[num] += delta
+            num += num & -num
+
+    def locate(self, index: int):
+        """Returns the block holding an index and the offset within that block"""
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError('BlockList index out of range')
+
+        block = 0
+        step = 1 << (len(self._tree) - 1).bit_length()
+        while step:
+            child = block + step
+            if child < len(self._tree) and self._tree[child] <= index:
+                block = child
+                index -= self._tree[child]
+            step >>= 1
+        return block, index
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self._blocks)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._len)
+            if step != 1:
+                return list(self)[index]
+            return self.page(start, stop)
+
+        block, offset = self.locate(index)
+        return self._blocks[block][offset]
+
+    def __delitem__(self, index: int):
+        self.pop(index)
+
+    def page(self, start: int, stop: int):
+        """Returns items start to stop without walking the items before start"""
+        start = max(start, 0)
+        stop = min(stop, self._len)
+        if start >= stop:
+            return []
+
+        block, offset = self.locate(start)
+        items = []
+        while len(items) < stop - start:
+            items.extend(self._blocks[block][offset:offset + stop - start - len(items)])
+            block += 1
+            offset = 0
+        return items
+
+    def append(self, item):
+        if not self._blocks or len(self._blocks[-1]) >= BLOCK_SIZE:
+            self._blocks.append([item])
+            self._len += 1
+            self.build_tree()
+        else:
+            self._blocks[-1].append(item)
+            self._len += 1
+            self.update(len(self._blocks) - 1, 1)
+
+    def insert(self, index: int, item):
+        if index < 0:
+            index = max(index + self._len, 0)
+        if index >= self._len:
+            return self.append(item)
+
+        block, offset = self.locate(index)
+        self._blocks[block].insert(offset, item)
+        self._len += 1
+        if len(self._blocks[block]) > 2 * BLOCK_SIZE:
+            half = len(self._blocks[block]) // 2
+            self._blocks[block:block + 1] = [self._blocks[block][:half], self._blocks[block][half:]]
+            self.build_tree()
+        else:
+            self.update(block, 1)
+
+    def pop(self, index: int = -1):
+        block, offset = self.locate(index)
+        item = self._blocks[block].pop(offset)
+        self._len -= 1
+        if not self._blocks[block]:
+            del self._blocks[block]
+            self.build_tree()
+        else:
+            self.update(block, -1)
+        return item
+
+    def popleft(self):
+        return self.pop(0)
+
+    def move(self, index: int, new_index: int):
+        self.insert(new_index, self.pop(index))
+
+    def clear(self):
+        self.rebuild([])
+
+    def shuffle(self):
+        items = list(self)
+        random.shuffle(items)
+        self.rebuild(items)
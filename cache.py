@@ -0,0 +1,330 @@
+import os
+import re
+import sys
+import json
+import time
+import hashlib
+import sqlite3
+
+COLUMNS = ('name', 'size', 'last_used', 'title', 'artist', 'duration', 'checksum')
+# Longer than any track plays for, pins of a process that died stop protecting files after this
+PIN_LEASE = 6 * 60 * 60
+# The index is used from the event loop, so waiting on another process's write has to stay short
+BUSY_TIMEOUT = 2
+# Last use times and hit counts are written in batches at most this often
+FLUSH_INTERVAL = 30
+
+def file_checksum(path: str):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+class CacheManager:
+    """Keeps a cache directory within a byte and entry budget by evicting the least recently used files.
+    Every cached file has a row in a SQLite index next to it holding its size, last use, tags and checksum,
+    so the directory is only scanned when there is no index yet. Pinned files are never evicted.
+    The index is the only record of sizes and pins, so several bot processes can share one cache directory.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, max_entries: int):
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.owner = os.getpid()
+        # Batched by lookup until the next flush: name -> last use, counter -> amount
+        self.uses = {}
+        self.counts = {}
+        self.flushed = time.monotonic()
+
+        self.db = sqlite3.connect(f"{directory}\\index.db", timeout=BUSY_TIMEOUT)
+        self.db.row_factory = sqlite3.Row
+        # Lets other processes keep reading while one of them writes
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                name TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL,
+                title TEXT,
+                artist TEXT,
+                duration INTEGER,
+                checksum TEXT
+            );
+            CREATE INDEX IF NOT EXISTS files_last_used ON files (last_used);
+            CREATE TABLE IF NOT EXISTS counters (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS pins (
+                name TEXT NOT NULL,
+                owner INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                expires REAL NOT NULL,
+                PRIMARY KEY (name, owner)
+            );
+        """)
+
+        self.load()
+
+    def path(self, name: str):
+        return f"{self.directory}\\{name}"
+
+    def load(self):
+        with self.db:
+            # Pins are leases, so ones left behind by a process that died run out on their own
+            self.db.execute("DELETE FROM pins WHERE expires < ? OR owner = ?", (time.time(), self.owner))
+        if self.db.execute("SELECT 1 FROM files LIMIT 1").fetchone() is None:
+            self.scan()
+
+    def scan(self):
+        files = [
+            entry for entry in os.scandir(self.directory)
+            if entry.is_file() and not entry.name.startswith((".", "index."))
+            and not entry.name.endswith((".part", ".tmp"))
+        ]
+        files.sort(key=lambda entry: entry.stat().st_atime)
+
+        rows = [(entry.name, entry.stat().st_size, entry.stat().st_atime) for entry in files]
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO files (name, size, last_used) VALUES (?, ?, ?)", rows)
+        return [(name, size) for name, size, _ in rows]
+
+    def count(self, counter: str, amount: int = 1):
+        self.counts[counter] = self.counts.get(counter, 0) + amount
+
+    def flush(self):
+        """Writes the batched last use times and counters, they stay batched if another process holds the index"""
+        uses, counts = self.uses, self.counts
+        self.uses, self.counts = {}, {}
+        self.flushed = time.monotonic()
+        try:
+            with self.db:
+                self.write_batch(uses, counts)
+        except sqlite3.OperationalError:
+            # Busy, the next flush takes them along
+            for name, last_used in uses.items():
+                self.uses.setdefault(name, last_used)
+            for counter, amount in counts.items():
+                self.count(counter, amount)
+
+    def write_batch(self, uses: dict, counts: dict):
+        self.db.executemany("UPDATE files SET last_used = MAX(last_used, ?) WHERE name = ?", [(last_used, name) for name, last_used in uses.items()])
+        self.db.executemany(
+            "INSERT INTO counters (name, value) VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET value = value + excluded.value",
+            list(counts.items())
+        )
+
+    def totals(self):
+        """Returns the number of cached files and their total size"""
+        row = self.db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM files").fetchone()
+        return row[0], row[1]
+
+    def lookup(self, name: str):
+        """Returns the index row of a cached file as a dict and marks it as recently used, or None on a miss.
+        Only reads the index, the use is written with the next batch.
+        """
+        row = self.db.execute("SELECT * FROM files WHERE name = ?", (name,)).fetchone()
+        if row is not None and os.path.isfile(self.path(name)):
+            self.uses[name] = time.time()
+            self.count('hits')
+            entry = dict(row)
+        else:
+            if row is not None:
+                # Removed behind the index's back, another lookup retries if the index is busy
+                try:
+                    with self.db:
+                        self.forget(name)
+                except sqlite3.OperationalError:
+                    pass
+            self.count('misses')
+            entry = None
+
+        if time.monotonic() - self.flushed > FLUSH_INTERVAL:
+            self.flush()
+        return entry
+
+    def add(self, name: str, **metadata):
+        """Records a file that was fully written to the cache directory and evicts to stay within budget.
+        Keyword arguments are stored as the file's title, artist, duration and checksum.
+        """
+        size = os.path.getsize(self.path(name))
+        row = {column : metadata.get(column) for column in COLUMNS}
+        row.update(name=name, size=size, last_used=time.time())
+
+        # Eviction goes by last use, so the batched uses have to be in the index first
+        self.flush()
+        with self.db:
+            self.db.execute(
+                f"INSERT OR REPLACE INTO files ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})",
+                [row[column] for column in COLUMNS]
+            )
+            self.evict()
+
+    def forget(self, name: str):
+        self.db.execute("DELETE FROM files WHERE name = ?", (name,))
+
+    def discard(self, name: str):
+        """Removes a file from the cache unless it is pinned"""
+        if self.is_pinned(name):
+            return
+        with self.db:
+            try:
+                os.remove(self.path(name))
+            except FileNotFoundError:
+                pass
+            self.forget(name)
+
+    def pin(self, name: str):
+        with self.db:
+            self.db.execute(
+                "INSERT INTO pins (name, owner, count, expires) VALUES (?, ?, 1, ?) "
+                "ON CONFLICT (name, owner) DO UPDATE SET count = count + 1, expires = excluded.expires",
+                (name, self.owner, time.time() + PIN_LEASE)
+            )
+
+    def unpin(self, name: str):
+        with self.db:
+            self.db.execute("UPDATE pins SET count = count - 1 WHERE name = ? AND owner = ?", (name, self.owner))
+            self.db.execute("DELETE FROM pins WHERE name = ? AND owner = ? AND count <= 0", (name, self.owner))
+
+    def is_pinned(self, name: str):
+        return self.db.execute("SELECT 1 FROM pins WHERE name = ? AND expires > ?", (name, time.time())).fetchone() is not None
+
+    def evict(self):
+        entries, total_bytes = self.totals()
+        if total_bytes <= self.max_bytes and entries <= self.max_entries:
+            return
+
+        rows = self.db.execute(
+            "SELECT name, size FROM files WHERE name NOT IN (SELECT name FROM pins WHERE expires > ?) ORDER BY last_used",
+            (time.time(),)
+        ).fetchall()
+        for name, size in rows:
+            if total_bytes <= self.max_bytes and entries <= self.max_entries:
+                break
+
+            try:
+                os.remove(self.path(name))
+            except FileNotFoundError:
+                pass
+            except OSError:
+                # Still open in another process on Windows, it goes on a later pass
+                continue
+            self.forget(name)
+            self.count('evictions')
+            total_bytes -= size
+            entries -= 1
+
+    def save(self):
+        self.flush()
+
+    def stats(self):
+        counters = dict(self.db.execute("SELECT name, value FROM counters").fetchall())
+        for counter, amount in self.counts.items():
+            counters[counter] = counters.get(counter, 0) + amount
+        hits = counters.get('hits', 0)
+        misses = counters.get('misses', 0)
+        entries, total_bytes = self.totals()
+        pinned = self.db.execute("SELECT COUNT(DISTINCT name) FROM pins WHERE expires > ?", (time.time(),)).fetchone()[0]
+        return {
+            "entries" : entries,
+            "max_entries" : self.max_entries,
+            "bytes" : total_bytes,
+            "max_bytes" : self.max_bytes,
+            "hits" : hits,
+            "misses" : misses,
+            "hit_rate" : hits / (hits + misses) if hits + misses else 0,
+            "evictions" : counters.get('evictions', 0),
+            "pinned" : pinned
+        }
+
+class MetadataCache:
+    """Persistent TTL cache of resolved track info, stored next to the audio cache index.
+    Misses are cached too (as None) for a shorter time so repeated bad searches don't hit the network.
+    """
+
+    def __init__(self, db: sqlite3.Connection, ttl: float, negative_ttl: float):
+
+        self.db = db
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+
+        with self.db:
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS metadata (
+                    key TEXT PRIMARY KEY,
+                    info TEXT,
+                    cached_at REAL NOT NULL,
+                    expires REAL NOT NULL
+                )
+            """)
+
+    @staticmethod
+    def id_key(extractor: str, video_id: str):
+        return f"id:{extractor}:{video_id}"
+
+    @staticmethod
+    def search_key(search: str):
+        return "search:" + re.sub(r'\s+', ' ', search.strip().casefold())
+
+    def get(self, keys: list):
+        """Returns (found, info, age in seconds) for the first live key, info is None for a cached miss"""
+        now = time.time()
+        for key in keys:
+            row = self.db.execute("SELECT info, cached_at, expires FROM metadata WHERE key = ?", (key,)).fetchone()
+            if row is None or row['expires'] < now:
+                continue
+
+            if row['info'] is None:
+                self.negative_hits += 1
+                return True, None, now - row['cached_at']
+
+            self.hits += 1
+            return True, json.loads(row['info']), now - row['cached_at']
+
+        self.misses += 1
+        return False, None, None
+
+    def put(self, keys: list, info: dict = None):
+        now = time.time()
+        expires = now + (self.ttl if info is not None else self.negative_ttl)
+        value = json.dumps(info) if info is not None else None
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO metadata (key, info, cached_at, expires) VALUES (?, ?, ?, ?)",
+                [(key, value, now, expires) for key in keys]
+            )
+
+    def stats(self):
+        lookups = self.hits + self.negative_hits + self.misses
+        return {
+            "hits" : self.hits,
+            "negative_hits" : self.negative_hits,
+            "misses" : self.misses,
+            "hit_rate" : (self.hits + self.negative_hits) / lookups if lookups else 0
+        }
+
+def format_stats(name: str, stats: dict):
+    return (
+        f"{name}: {stats['entries']} files, {stats['bytes'] / 1024 / 1024:.1f} MB, "
+        f"hit rate {stats['hit_rate']:.1%} ({stats['hits']} hits, {stats['misses']} misses), "
+        f"{stats['evictions']} evicted"
+    )
+
+def format_metadata_stats(name: str, stats: dict):
+    return (
+        f"{name}: hit rate {stats['hit_rate']:.1%} "
+        f"({stats['hits']} hits, {stats['negative_hits']} cached misses, {stats['misses']} misses)"
+    )
+
+if __name__ == "__main__":
+    # Reports usage from the saved indexes, run from the bot directory: python cache.py [directory...]
+    for directory in sys.argv[1:] or ["audio_cache", "image_cache"]:
+        manager = CacheManager(directory, max_bytes=0, max_entries=0)
+        print(format_stats(directory, manager.stats()))
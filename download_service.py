@@ -0,0 +1,266 @@
+"""Runs downloads, tag parsing, cover art and opus transcoding outside the bot process.
+Start it standalone with `python main.py --download-service`, or let the bot start it when download_service is set.
+Requests and replies are newline delimited JSON over a localhost TCP connection:
+
+    {"id": 1, "source_type": "YouTube", "data": {...}}
+    {"id": 1, "event": "progress", "downloaded_bytes": 1048576, "total_bytes": 4194304}
+    {"id": 1, "event": "done", "data": {...}}
+    {"id": 1, "event": "error", "message": "..."}
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import functools
+import subprocess
+
+# SourceDL imports this module too, so its classes are only named in quotes in annotations
+import SourceDL
+import gdrive
+from main import INFO, DEBUG, config
+
+HOST = "127.0.0.1"
+PROGRESS_INTERVAL = 1
+
+class DownloadServiceError(Exception):
+    pass
+
+class ServiceUnavailable(DownloadServiceError):
+    pass
+
+class Job:
+    """A download running in the service, shared by every request for the same file"""
+    __slots__ = ('key', 'task', 'subscribers', 'progress', 'reported')
+
+    def __init__(self, key: str):
+        self.key = key
+        self.task = None
+        self.subscribers = []
+        self.progress = None
+        self.reported = 0
+
+class DownloadServer:
+
+    def __init__(self, backends: 'SourceDL.Backends', port: int, loop: asyncio.BaseEventLoop = None):
+
+        self.backends = backends
+        self.port = port
+        self.loop = loop or asyncio.get_event_loop()
+        self.server = None
+
+        # expected_filename -> Job
+        self.jobs = {}
+        self.submitted = 0
+        self.deduped = 0
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, HOST, self.port)
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+        for job in self.jobs.values():
+            job.task.cancel()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        subscriptions = []
+        try:
+            async for line in reader:
+                try:
+                    request = json.loads(line)
+                    request_id = request['id']
+                except (ValueError, KeyError, TypeError) as e:
+                    INFO(f"Ignoring malformed download request: {e}")
+                    continue
+
+                try:
+                    job = self.submit(request['source_type'], request['data'])
+                except (ValueError, KeyError, TypeError) as e:
+                    INFO(f"Rejecting download request: {e}")
+                    self.send(writer, {"id" : request_id, "event" : "error", "message" : str(e)})
+                    continue
+
+                subscriber = (writer, request_id)
+                job.subscribers.append(subscriber)
+                subscriptions.append((job, subscriber))
+                if job.progress:
+                    self.send(writer, {"id" : request_id, "event" : "progress", **job.progress})
+        except ConnectionError:
+            pass
+        finally:
+            # Downloads keep going without subscribers so the file still ends up in the cache
+            for job, subscriber in subscriptions:
+                if subscriber in job.subscribers:
+                    job.subscribers.remove(subscriber)
+            writer.close()
+
+    def submit(self, source_type: str, data: dict):
+        key = data['expected_filename']
+        # Any local process can connect, so the name must not point anywhere outside the cache directory
+        if not isinstance(key, str) or not key or ".." in key or any(separator in key for separator in ("/", "\\", ":")):
+            raise ValueError('Refusing to download to `{}`'.format(key))
+        job = self.jobs.get(key)
+        if job is not None:
+            self.deduped += 1
+            return job
+
+        self.submitted += 1
+        job = Job(key)
+        job.task = self.loop.create_task(self.run(job, source_type, data))
+        self.jobs[key] = job
+        return job
+
+    async def run(self, job: Job, source_type: str, data: dict):
+        INFO(f"Download service fetching {data['title']}")
+        progress = functools.partial(self.report, job)
+        try:
+            result = await self.backends.download(source_type, SourceDL.DataClass(**data), progress)
+            message = {"event" : "done", "data" : result.__dict__}
+        except asyncio.CancelledError:
+            message = {"event" : "error", "message" : "The download service is shutting down"}
+            raise
+        except Exception as e:
+            INFO(f"Download service failed to fetch {data['title']}: {e}")
+            message = {"event" : "error", "message" : str(e)}
+        finally:
+            del self.jobs[job.key]
+            for writer, request_id in job.subscribers:
+                self.send(writer, {"id" : request_id, **message})
+
+    def report(self, job: Job, downloaded_bytes: int, total_bytes: int):
+        job.progress = {"downloaded_bytes" : downloaded_bytes, "total_bytes" : total_bytes}
+        now = time.monotonic()
+        if now - job.reported < PROGRESS_INTERVAL:
+            return
+        job.reported = now
+
+        for writer, request_id in job.subscribers:
+            self.send(writer, {"id" : request_id, "event" : "progress", **job.progress})
+
+    @staticmethod
+    def send(writer: asyncio.StreamWriter, message: dict):
+        if not writer.is_closing():
+            writer.write(json.dumps(message).encode() + b"\n")
+
+class DownloadClient:
+    """Connection from the bot to the download service, started on first use if spawn is set"""
+
+    def __init__(self, port: int, spawn: bool = True, loop: asyncio.BaseEventLoop = None):
+
+        self.port = port
+        self.spawn = spawn
+        self.loop = loop or asyncio.get_event_loop()
+
+        self.writer = None
+        self.listener = None
+        self.process = None
+        self.connect_lock = asyncio.Lock()
+        # request id -> (future, progress callback)
+        self.pending = {}
+        self.next_id = 0
+
+    async def connect(self):
+        async with self.connect_lock:
+            if self.writer is not None and not self.writer.is_closing():
+                return
+
+            try:
+                reader, writer = await asyncio.open_connection(HOST, self.port)
+            except OSError as e:
+                if not self.spawn:
+                    raise ServiceUnavailable('Couldn\'t connect to the download service: {}'.format(e))
+                reader, writer = await self.start_service()
+
+            self.writer = writer
+            self.listener = self.loop.create_task(self.listen(reader))
+
+    async def start_service(self):
+        if self.process is None or self.process.poll() is not None:
+            INFO("Starting download service")
+            # The service outlives the worker that started it, so it gets its own temporary file names and no shards
+            env = dict(os.environ)
+            env['BOT_WORKER_ID'] = "service"
+            env.pop('BOT_SHARD_IDS', None)
+            env.pop('BOT_SHARD_COUNT', None)
+            self.process = subprocess.Popen([sys.executable, "main.py", "--download-service"], env=env)
+
+        for _ in range(20):
+            await asyncio.sleep(0.5)
+            try:
+                return await asyncio.open_connection(HOST, self.port)
+            except OSError:
+                continue
+        raise ServiceUnavailable('Download service didn\'t start listening on port {}'.format(self.port))
+
+    async def listen(self, reader: asyncio.StreamReader):
+        try:
+            async for line in reader:
+                message = json.loads(line)
+                future, progress = self.pending.get(message['id'], (None, None))
+                if future is None or future.done():
+                    continue
+
+                if message['event'] == "progress":
+                    if progress is not None:
+                        progress(message['downloaded_bytes'], message['total_bytes'])
+                elif message['event'] == "done":
+                    future.set_result(message['data'])
+                else:
+                    future.set_exception(DownloadServiceError(message['message']))
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            self.writer = None
+            for future, _ in self.pending.values():
+                if not future.done():
+                    future.set_exception(ServiceUnavailable('Lost the connection to the download service'))
+
+    async def fetch(self, source_type: str, data: 'SourceDL.DataClass', progress=None):
+        """Has the service download a track into the shared cache and returns its updated data as a dict"""
+        await self.connect()
+
+        self.next_id += 1
+        request_id = self.next_id
+        future = self.loop.create_future()
+        self.pending[request_id] = (future, progress)
+        try:
+            if self.writer is None:
+                raise ServiceUnavailable('Lost the connection to the download service')
+            self.writer.write(json.dumps({"id" : request_id, "source_type" : source_type, "data" : data.__dict__}).encode() + b"\n")
+            return await future
+        finally:
+            self.pending.pop(request_id, None)
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+
+def log_progress(data: 'SourceDL.DataClass'):
+    def progress(downloaded_bytes: int, total_bytes: int):
+        DEBUG(f"{data.title}: {downloaded_bytes} of {total_bytes} bytes")
+    return progress
+
+def main():
+    loop = asyncio.get_event_loop()
+    backends = SourceDL.Backends(loop, download_only=True)
+    server = DownloadServer(backends, config.get('download_service_port', 8765), loop)
+    try:
+        loop.run_until_complete(server.start())
+    except OSError as e:
+        # Another bot process already started one
+        INFO(f"Download service not started: {e}")
+        return
+
+    INFO(f"Download service listening on {HOST}:{server.port}")
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        loop.run_until_complete(gdrive.client.close())
+        backends.audio_cache.save()
+        backends.image_cache.save()
@@ -0,0 +1,230 @@
+import asyncio
+import shutil
+import subprocess
+import threading
+import time
+from collections import deque
+
+import discord
+from discord.oggparse import OggStream
+from discord.player import CREATE_NO_WINDOW
+
+from main import INFO
+
+# Same output discord.FFmpegOpusAudio produces for opus input, but read from stdin so it can start before the input is known
+WORKER_ARGS = (
+    '-f', 'ogg', '-i', 'pipe:0',
+    '-map_metadata', '-1',
+    '-f', 'opus',
+    '-c:a', 'copy',
+    '-ar', '48000',
+    '-ac', '2',
+    '-loglevel', 'warning',
+    'pipe:1'
+)
+
+class StdinOpusAudio(discord.FFmpegOpusAudio):
+    """An FFmpegOpusAudio whose ffmpeg reads its input from stdin, written by a feeder thread"""
+
+    def cleanup(self):
+        # FFmpegAudio.cleanup would communicate() with a stdin the feeder may already have closed
+        process = self._process
+        if process is None:
+            return
+        try:
+            process.kill()
+        except OSError:
+            pass
+        process.wait()
+        process.stdout.close()
+        self._process = self._stdout = None
+
+class PooledOpusAudio(StdinOpusAudio):
+    """Plays an opus file through an already running ffmpeg worker, feeding the file to its stdin from a thread"""
+
+    def __init__(self, process: subprocess.Popen, path: str):
+        # FFmpegAudio.__init__ would spawn a new process, this one is already running
+        self._process = process
+        self._stdout = process.stdout
+        self._packet_iter = OggStream(self._stdout).iter_packets()
+
+        self.feeder = threading.Thread(target=self.feed, args=(process.stdin, path), daemon=True)
+        self.feeder.start()
+
+    @staticmethod
+    def feed(stdin, path: str):
+        try:
+            with open(path, 'rb') as f:
+                shutil.copyfileobj(f, stdin, 64 * 1024)
+        except (OSError, ValueError):
+            # The worker was killed by cleanup() before the whole file went in
+            pass
+        finally:
+            try:
+                stdin.close()
+            except OSError:
+                pass
+
+class PipedOpusAudio(StdinOpusAudio):
+    """Encodes a stream to opus, feeding ffmpeg the chunks an async iterator yields on the event loop.
+    Nothing about where the stream comes from, such as credentials, ends up on ffmpeg's command line.
+    """
+
+    def __init__(self, chunks, loop: asyncio.BaseEventLoop, **kwargs):
+        super().__init__(subprocess.PIPE, pipe=True, **kwargs)
+        self.chunks = chunks
+        self.loop = loop
+
+        self.feeder = threading.Thread(target=self.feed, args=(self._process.stdin,), daemon=True)
+        self.feeder.start()
+
+    async def next_chunk(self):
+        return await self.chunks.__anext__()
+
+    def feed(self, stdin):
+        try:
+            while True:
+                try:
+                    chunk = asyncio.run_coroutine_threadsafe(self.next_chunk(), self.loop).result()
+                except StopAsyncIteration:
+                    break
+                stdin.write(chunk)
+        except (OSError, ValueError):
+            # Killed by cleanup() before the stream ended
+            pass
+        except Exception as e:
+            INFO(f"Stream ended early: {e}")
+        finally:
+            asyncio.run_coroutine_threadsafe(self.chunks.aclose(), self.loop)
+            try:
+                stdin.close()
+            except OSError:
+                pass
+
+class FFmpegPool:
+    """Keeps a few idle ffmpeg workers spawned ahead of time so starting a track doesn't wait on a fork and exec.
+    Workers are single use since ffmpeg exits at the end of its input, each one handed out is replaced in the background.
+    Idle workers that died or have waited longer than max_idle are replaced by the periodic health check.
+    """
+
+    def __init__(self, size: int, max_idle: float = 600, check_interval: float = 30, executable: str = 'ffmpeg', loop: asyncio.BaseEventLoop = None):
+
+        self.size = size
+        self.max_idle = max_idle
+        self.check_interval = check_interval
+        self.executable = executable
+        self.loop = loop or asyncio.get_event_loop()
+
+        # (spawned_time, process), oldest first
+        self.idle = deque()
+        self.spawning = 0
+        self.checker = None
+
+        self.hits = 0
+        self.misses = 0
+        self.spawned = 0
+        self.failed = 0
+        self.unhealthy = 0
+
+    def start(self):
+        if self.size > 0 and self.checker is None:
+            self.checker = self.loop.create_task(self.check_task())
+
+    def stop(self):
+        if self.checker is not None:
+            self.checker.cancel()
+            self.checker = None
+        while self.idle:
+            _, process = self.idle.popleft()
+            self.kill(process)
+
+    def spawn(self):
+        return subprocess.Popen(
+            [self.executable, *WORKER_ARGS],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            creationflags=CREATE_NO_WINDOW
+        )
+
+    def fill(self):
+        while self.checker is not None and len(self.idle) + self.spawning < self.size:
+            self.spawning += 1
+            future = self.loop.run_in_executor(None, self.spawn)
+            future.add_done_callback(self.spawn_done)
+
+    def spawn_done(self, future: asyncio.Future):
+        self.spawning -= 1
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            self.failed += 1
+            INFO(f"Failed to spawn ffmpeg worker: {future.exception()}")
+            return
+
+        process = future.result()
+        if self.checker is None:
+            # Stopped while it was spawning
+            self.kill(process)
+            return
+        self.spawned += 1
+        self.idle.append((time.time(), process))
+
+    async def check_task(self):
+        while True:
+            self.check()
+            self.fill()
+            # Don't respawn in a tight loop if ffmpeg keeps failing to start
+            await asyncio.sleep(self.check_interval)
+
+    def check(self):
+        now = time.time()
+        for _ in range(len(self.idle)):
+            spawned_time, process = self.idle.popleft()
+            if process.poll() is not None or now - spawned_time > self.max_idle:
+                self.unhealthy += process.poll() is not None
+                self.kill(process)
+            else:
+                self.idle.append((spawned_time, process))
+
+    def acquire(self, path: str):
+        """Returns a PooledOpusAudio playing an opus file, or None if there is no healthy idle worker"""
+        while self.idle:
+            _, process = self.idle.popleft()
+            if process.poll() is None:
+                self.hits += 1
+                self.fill()
+                return PooledOpusAudio(process, path)
+            self.unhealthy += 1
+            self.kill(process)
+
+        self.misses += 1
+        self.fill()
+        return None
+
+    @staticmethod
+    def kill(process: subprocess.Popen):
+        try:
+            process.kill()
+        except OSError:
+            pass
+        # Reaps it once it exits without blocking the event loop
+        threading.Thread(target=process.communicate, daemon=True).start()
+
+    def stats(self):
+        acquired = self.hits + self.misses
+        return {
+            "size" : self.size,
+            "idle" : len(self.idle),
+            "hits" : self.hits,
+            "misses" : self.misses,
+            "hit_rate" : self.hits / acquired if acquired else 0,
+            "spawned" : self.spawned,
+            "failed" : self.failed,
+            "unhealthy" : self.unhealthy
+        }
+
+def format_stats(stats: dict):
+    return (
+        f"FFmpeg pool: {stats['idle']}/{stats['size']} idle, hit rate {stats['hit_rate']:.1%} "
+        f"({stats['hits']} hits, {stats['misses']} misses), {stats['unhealthy']} unhealthy, {stats['failed']} failed spawns"
+    )
@@ -1,45 +1,221 @@
 import os
 import json
 import time
-from io import BytesIO
+import random
+import asyncio
+import functools
+from datetime import datetime, timezone
 
+import aiohttp
 from pathvalidate import sanitize_filename
 from aiogoogle import Aiogoogle
-from PIL import Image
+from aiogoogle.resource import GoogleAPI
+from aiogoogle.sessions.aiohttp_session import AiohttpSession
 from mutagen.mp3 import MP3
 
-from main import INFO
+import cache
+from thumbnails import ThumbnailCache
+from main import INFO, WORKER_ID, config
+
+DISCOVERY_CACHE = "drive_cache\\drive_v3.json"
+DISCOVERY_TTL = 7 * 24 * 60 * 60
+TOKEN_FILE = "token.json"
+CREDENTIALS_FILE = "credentials.json"
+LISTING_CACHE = "drive_cache\\listing-{}.json"
+MEDIA_URL = "https://www.googleapis.com/drive/v3/files/{}?alt=media&supportsAllDrives=true"
+DEFAULT_THUMBNAIL = "https://webrandum.net/mskz/wp-content/uploads/pz-linkcard/cache/7232681e168b08a699569b8291bbeaa3c0435198368ccf2b11fa8cca02e5e115"
 
 class GDriveError(Exception):
     pass
 
-class GDriveSource:
+class GDriveRetryError(GDriveError):
+    """A media request failed in a way retrying can fix, such as rate limiting or a server error"""
+    pass
 
-    def __init__(self):
-        with open("credentials.json") as f:
-            self.client_creds = json.load(f)
+class DriveClient:
+    """Process wide Drive client.
+    Holds one HTTP session for every Drive call and the parsed discovery document,
+    which is persisted to disk and only fetched again once it is older than the TTL.
+    """
+
+    def __init__(self, discovery_ttl: int = DISCOVERY_TTL):
+        self.discovery_ttl = discovery_ttl
+        self.session = None
+        self.media_session = None
+        self.aiogoogle = Aiogoogle(session_factory=self.get_session)
+        self.drive_v3 = None
+        self.discover_lock = asyncio.Lock()
+
+    def get_session(self):
+        # aiogoogle closes sessions it opens for itself, so a closed one is replaced instead of reused
+        if self.session is None or self.session._session.closed:
+            self.session = AiohttpSession()
+        return self.session
+
+    def get_media_session(self):
+        # Media downloads need ranged requests aiogoogle doesn't expose, so they get their own pool
+        if self.media_session is None:
+            self.media_session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(sock_read=60))
+        return self.media_session
+
+    async def api(self):
+        if self.drive_v3 is None:
+            async with self.discover_lock:
+                if self.drive_v3 is None:
+                    self.drive_v3 = await self.load_discovery()
+        return self.drive_v3
+
+    async def load_discovery(self):
+        cached_document = None
+        if os.path.isfile(DISCOVERY_CACHE):
+            with open(DISCOVERY_CACHE) as f:
+                cached_document = json.load(f)
+            if time.time() - os.path.getmtime(DISCOVERY_CACHE) < self.discovery_ttl:
+                return GoogleAPI(cached_document)
 
-        with open("token.json") as f:
+        try:
+            drive_v3 = await self.aiogoogle.discover('drive', 'v3')
+        except Exception as e:
+            if cached_document is None:
+                raise
+            INFO(f"Using stale Drive discovery document: {e}")
+            return GoogleAPI(cached_document)
+
+        with open(f"{DISCOVERY_CACHE}.{WORKER_ID}.tmp", 'w') as f:
+            json.dump(drive_v3.discovery_document, f)
+        os.replace(f"{DISCOVERY_CACHE}.{WORKER_ID}.tmp", DISCOVERY_CACHE)
+        return drive_v3
+
+    async def as_user(self, request, user_creds: dict):
+        return await self.aiogoogle.as_user(request, user_creds=user_creds)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+        if self.media_session is not None:
+            await self.media_session.close()
+            self.media_session = None
+
+client = DriveClient()
+
+class TokenManager:
+    """Process wide Drive access token.
+    The token is refreshed shortly before its expires_at rather than on a timer,
+    concurrent callers share a single refresh and token.json is written off the event loop.
+    """
+
+    def __init__(self, token_file: str = TOKEN_FILE, credentials_file: str = CREDENTIALS_FILE, margin: int = 300):
+        self.token_file = token_file
+        self.credentials_file = credentials_file
+        self.margin = margin
+        self.client_creds = None
+        self.user_creds = None
+        self.expires_at = 0
+        self.refreshing = None
+        self.save_lock = asyncio.Lock()
+
+    def load(self):
+        with open(self.credentials_file) as f:
+            self.client_creds = json.load(f)
+        with open(self.token_file) as f:
             self.user_creds = json.load(f)
+        self.expires_at = self.parse_expiry(self.user_creds.get('expires_at'))
+
+    @staticmethod
+    def parse_expiry(expires_at: str):
+        # aiogoogle stores expires_at as a naive UTC timestamp
+        if not expires_at:
+            return 0
+        try:
+            return datetime.fromisoformat(expires_at).replace(tzinfo=timezone.utc).timestamp()
+        except ValueError:
+            return 0
+
+    async def get(self):
+        """Returns user credentials holding an access token that is valid for at least `margin` more seconds"""
+        if self.user_creds is None:
+            self.load()
+        if time.time() < self.expires_at - self.margin:
+            return self.user_creds
+
+        if self.refreshing is None:
+            self.refreshing = asyncio.get_event_loop().create_task(self.refresh())
+        refreshing = self.refreshing
+        try:
+            return await asyncio.shield(refreshing)
+        finally:
+            if self.refreshing is refreshing and refreshing.done():
+                self.refreshing = None
+
+    def invalidate(self, access_token: str):
+        """Marks a token Drive rejected as expired, unless it was already replaced"""
+        if self.user_creds is not None and self.user_creds.get('access_token') == access_token:
+            self.expires_at = 0
+
+    async def refresh(self):
+        request_creds = dict(self.user_creds)
+        # Without expires_at aiogoogle refreshes unconditionally instead of comparing against its own margin
+        request_creds.pop('expires_at', None)
+        try:
+            # aiogoogle closes the session a refresh runs on, so it gets a short-lived client of its own
+            aiogoogle = Aiogoogle(client_creds=self.client_creds)
+            _, creds = await aiogoogle.oauth2.refresh(request_creds, self.client_creds)
+        except Exception as e:
+            raise GDriveError('Couldn\'t refresh the Drive access token: {}'.format(e))
+
+        creds = dict(creds)
+        creds['refresh_token'] = creds.get('refresh_token') or self.user_creds['refresh_token']
+        self.user_creds = creds
+        self.expires_at = self.parse_expiry(creds.get('expires_at')) or time.time() + creds.get('expires_in', 3600)
+        INFO("Refreshed Drive access token")
+
+        asyncio.get_event_loop().create_task(self.persist(creds))
+        return creds
+
+    async def persist(self, creds: dict):
+        async with self.save_lock:
+            try:
+                await asyncio.get_event_loop().run_in_executor(None, self.save, creds)
+            except OSError as e:
+                INFO(f"Failed to save {self.token_file}: {e}")
+
+    def save(self, creds: dict):
+        with open(f"{self.token_file}.{WORKER_ID}.tmp", 'w') as f:
+            json.dump(creds, f)
+        os.replace(f"{self.token_file}.{WORKER_ID}.tmp", self.token_file)
+
+tokens = TokenManager()
+
+class GDriveSource:
 
-        self.refreshtoken = self.user_creds['refresh_token']
+    def __init__(self, audio_cache: cache.CacheManager, thumbnails: ThumbnailCache):
+        self.audio_cache = audio_cache
+        self.thumbnails = thumbnails
 
-        self.refreshed = False
-        self.refreshed_time = None
+        self.listing_locks = {}
+        # folder id -> listing, read from drive_cache once and then kept current in memory
+        self.listings = {}
+        # expected_filename -> (download task, progress listeners)
+        self.downloads = {}
         self.process = None
 
-    async def create_source(self, search: str):
-        await self.refresh_token()
+        self.chunk_size = config.get('drive_chunk_mb', 8) * 1024 * 1024
+        self.max_retries = config.get('drive_max_retries', 8)
+        self.backoff_cap = config.get('drive_backoff_cap', 60)
 
-        async with Aiogoogle(user_creds=self.user_creds) as aiogoogle:
-            drive_v3 = await aiogoogle.discover('drive', 'v3')
-            data = await aiogoogle.as_user(
-                drive_v3.files.get(
-                    fileId=search,
-                    fields='id,name,owners(displayName),createdTime,webViewLink',
-                    supportsAllDrives=True
-                )
-            )
+    async def create_source(self, search: str):
+        user_creds = await tokens.get()
+
+        drive_v3 = await client.api()
+        data = await client.as_user(
+            drive_v3.files.get(
+                fileId=search,
+                fields='id,name,owners(displayName),createdTime,webViewLink,md5Checksum,size',
+                supportsAllDrives=True
+            ),
+            user_creds
+        )
 
         sorted_info = await self.sort_info(data, search)
         return sorted_info
@@ -47,8 +223,11 @@ class GDriveSource:
     @staticmethod
     async def sort_info(data: dict, search: str):
 
-        expected_filename = sanitize_filename(data['name'])
-        name = expected_filename.rsplit(".", 1)[0]
+        name = sanitize_filename(data['name']).rsplit(".", 1)[0]
+        extension = sanitize_filename(data['name'].rsplit(".", 1)[1]) if "." in data['name'] else ""
+        if not extension.isalnum():
+            # "Track 1.final mix" has no real extension, ffmpeg probes the contents anyway
+            extension = "mp3"
 
         info = {
             "search" : search,
@@ -58,130 +237,396 @@ class GDriveSource:
             "webpage_url" : data['webViewLink'],
             "duration" : 0,
             "thumbnail" : None,
-            "expected_filename" : expected_filename
+            "expected_filename" : f"gdrive-{data['id']}.{extension}",
+            "image_filename" : None,
+            "checksum" : data.get('md5Checksum'),
+            "size" : int(data['size']) if 'size' in data else None
+        }
+
+        return info
+
+    @staticmethod
+    def placeholder_info(search: str, name: str = None):
+
+        info = {
+            "search" : search,
+            "artist" : "Unknown",
+            "uploader" : "Unknown",
+            "title" : name.rsplit(".", 1)[0] if name else search,
+            "webpage_url" : f"https://drive.google.com/file/d/{search}/view",
+            "duration" : 0,
+            "thumbnail" : None,
+            "expected_filename" : None,
+            "image_filename" : None,
+            "checksum" : None,
+            "size" : None
         }
 
         return info
 
-    async def ready_download(self, data: dict):
+    async def ready_download(self, data: dict, progress=None):
 
         INFO(f"Started downloading {data.title} from {data.search}")
-        await self.refresh_token()
-        while not os.path.isfile(f"audio_cache\\{data.expected_filename}"):
-            async with Aiogoogle(user_creds=self.user_creds) as aiogoogle:
-                drive_v3 = await aiogoogle.discover('drive', 'v3')
-                try:
-                    await aiogoogle.as_user(
-                        drive_v3.files.get(fileId=data.search, download_file=f"audio_cache\\{data.expected_filename}", alt="media")
-                    )
-                except Exception as e:
-                    if str(e) == "Line is too long":
-                        pass
-                    else:
-                        INFO(e)
+        picture = None
+        entry = self.audio_cache.lookup(data.expected_filename)
+        if entry is None:
+            # Every play of the same file waits on one download, the download finishes even if they all stop waiting
+            if data.expected_filename not in self.downloads:
+                task = asyncio.get_event_loop().create_task(self.download_track(data))
+                task.add_done_callback(functools.partial(self.download_done, data.expected_filename))
+                self.downloads[data.expected_filename] = (task, [])
+            task, listeners = self.downloads[data.expected_filename]
+
+            if progress is not None:
+                listeners.append(progress)
+            try:
+                artist, duration, picture = await asyncio.shield(task)
+            finally:
+                if progress is not None:
+                    listeners.remove(progress)
+            data.artist = artist or data.artist
+            data.duration = duration
+        else:
+            data.artist = entry['artist'] or "Unknown"
+            data.duration = entry['duration'] or 0
         INFO(f"Downloaded {data.title}")
 
+        await self.ready_thumbnail(data, picture)
+
+        return data
+
+    async def download_track(self, data: dict):
+        """Downloads a file into the cache and returns its artist, duration and cover art"""
+        await self.download_file(data, functools.partial(self.report_progress, data.expected_filename))
+        partial = functools.partial(self.read_tags, self.audio_cache.path(data.expected_filename))
+        tags = await asyncio.get_event_loop().run_in_executor(None, partial)
+        artist, duration, picture = tags if tags is not None else (None, data.duration, None)
+
+        self.audio_cache.add(
+            data.expected_filename,
+            title=data.title,
+            artist=artist or data.artist,
+            duration=duration,
+            checksum=data.checksum
+        )
+        return artist, duration, picture
+
+    def download_done(self, filename: str, task: asyncio.Task):
+        if self.downloads.get(filename, (None, None))[0] is task:
+            del self.downloads[filename]
+
+    def report_progress(self, filename: str, downloaded_bytes: int, total_bytes: int):
+        _, listeners = self.downloads.get(filename, (None, ()))
+        for listener in list(listeners):
+            listener(downloaded_bytes, total_bytes)
+
+    async def ready_thumbnail(self, data: dict, picture: bytes = None):
+        """Points data at the track's cached cover art thumbnail, extracting it from the file if it isn't cached yet"""
+        source = f"gdrive-{data.search}"
+        name = self.thumbnails.lookup(source)
+        if name is None and picture is None and not data.expected_filename.endswith(".opus"):
+            partial = functools.partial(self.read_tags, self.audio_cache.path(data.expected_filename))
+            tags = await asyncio.get_event_loop().run_in_executor(None, partial)
+            if tags is not None:
+                picture = tags[2]
+        if name is None and picture is not None:
+            name = await self.thumbnails.add(source, picture)
+
+        if name is None:
+            data.thumbnail = DEFAULT_THUMBNAIL
+            return
+        data.image_filename = name
+        await self.thumbnails.load(name)
+
+    async def stream_source(self, data: dict):
+        # ffmpeg can't seek back to the index at the end of mp4 files read from a pipe
+        if data.expected_filename.rsplit(".", 1)[-1] in ("m4a", "mp4", "mov"):
+            return None
+        return self.iter_media(data), None
+
+    async def iter_media(self, data: dict, offset: int = 0):
+        """Yields a file's bytes from offset on in ranged requests, resuming where it left off after failures.
+        Network errors and the replies check_media_response marks as retryable are retried with backoff, anything else raises.
+        Every request takes the access token current at the time, so long transfers outlive the token they started with.
+        """
+
+        url = MEDIA_URL.format(data.search)
+        failures = 0
+        while data.size is None or offset < data.size:
+            user_creds = await tokens.get()
+            headers = {
+                "Authorization" : f"Bearer {user_creds['access_token']}",
+                "Range" : f"bytes={offset}-{offset + self.chunk_size - 1}"
+            }
+            received = 0
+            try:
+                async with client.get_media_session().get(url, headers=headers) as response:
+                    if response.status == 416:
+                        # Nothing left past offset, the file is done or shrank since it was looked up
+                        return
+                    self.check_media_response(response, user_creds)
+
+                    # A plain 200 means the range was ignored and the whole file is coming from the start
+                    skip = offset if response.status == 200 else 0
+                    async for chunk in response.content.iter_chunked(64 * 1024):
+                        if skip:
+                            dropped = min(skip, len(chunk))
+                            chunk = chunk[dropped:]
+                            skip -= dropped
+                            if not chunk:
+                                continue
+                        received += len(chunk)
+                        offset += len(chunk)
+                        yield chunk
+                    full_response = response.status == 200
+            except (aiohttp.ClientError, asyncio.TimeoutError, GDriveRetryError) as e:
+                failures += 1
+                if failures > self.max_retries:
+                    raise GDriveError('Couldn\'t fetch `{}`: {}'.format(data.title, e))
+
+                delay = min(self.backoff_cap, 2 ** (failures - 1)) * random.uniform(0.5, 1)
+                INFO(f"Request for {data.title} failed at byte {offset}, retrying in {delay:.1f}s: {e}")
+                await asyncio.sleep(delay)
+                continue
+            except GDriveError as e:
+                raise GDriveError('Couldn\'t fetch `{}`: {}'.format(data.title, e))
+
+            failures = 0
+            if full_response or received < self.chunk_size:
+                return
+
+    @staticmethod
+    def check_media_response(response: aiohttp.ClientResponse, user_creds: dict):
+        if response.status == 401:
+            tokens.invalidate(user_creds['access_token'])
+            raise GDriveRetryError('Access token was rejected')
+        if response.status == 429 or response.status >= 500:
+            raise GDriveRetryError(f'Drive returned HTTP {response.status}')
+        if response.status not in (200, 206):
+            # Deleted, unshared or otherwise off limits, waiting won't bring it back
+            raise GDriveError(f'Drive returned HTTP {response.status}')
+
+    async def download_file(self, data: dict, progress=None):
+        """Downloads a file into a .part file, resuming from the last written byte if an earlier attempt left one behind.
+        The file is checked against the size and md5Checksum Drive reported before it is moved into place.
+        progress(downloaded_bytes, total_bytes) is called at the start and after every chunk.
+        """
+
+        part_file = f"{self.audio_cache.path(data.expected_filename)}.{WORKER_ID}.part"
+        offset = os.path.getsize(part_file) if os.path.isfile(part_file) else 0
+        if progress is not None:
+            progress(offset, data.size)
+
         try:
-            tags = MP3(f"audio_cache\\{data.expected_filename}")
+            with open(part_file, 'ab') as f:
+                async for chunk in self.iter_media(data, offset):
+                    f.write(chunk)
+                    if progress is not None and (offset + len(chunk)) // self.chunk_size != offset // self.chunk_size:
+                        progress(offset + len(chunk), data.size)
+                    offset += len(chunk)
+        except BaseException:
+            # What was written is kept for the next attempt to resume from, an empty file isn't worth keeping
+            if offset == 0:
+                os.remove(part_file)
+            raise
+
+        if data.size is not None and offset < data.size:
+            # Drive has fewer bytes than it reported when the file was looked up, retrying won't change that
+            os.remove(part_file)
+            raise GDriveError('`{}` changed on Drive while it was downloading'.format(data.title))
+
+        await self.verify_file(data, part_file)
+
+        # Only complete files ever appear under their final name
+        os.replace(part_file, self.audio_cache.path(data.expected_filename))
+
+    async def verify_file(self, data: dict, part_file: str):
+        size = os.path.getsize(part_file)
+        if data.size is not None and size != data.size:
+            os.remove(part_file)
+            raise GDriveError('Downloaded {} bytes of `{}`, expected {}'.format(size, data.title, data.size))
+
+        if data.checksum:
+            partial = functools.partial(cache.file_checksum, part_file)
+            checksum = await asyncio.get_event_loop().run_in_executor(None, partial)
+            if checksum != data.checksum:
+                os.remove(part_file)
+                raise GDriveError('Checksum mismatch for `{}`'.format(data.title))
+
+    @staticmethod
+    def read_tags(path: str):
+        """Returns the artist, duration and embedded cover art of an mp3, or None if it can't be parsed"""
+        try:
+            tags = MP3(path)
         except:
-            return data
-        if not os.path.isfile(f"image_cache\\{data.title}.jpg"):
-            try:
-                pic_key = [key for key in list(tags.keys()) if "APIC" in key][0]
-                pic = tags.get(pic_key)
-                im = Image.open(BytesIO(pic.data))
-                im.save(f"image_cache\\{data.title}.jpg")
-            except:
-                data.thumbnail = "https://webrandum.net/mskz/wp-content/uploads/pz-linkcard/cache/7232681e168b08a699569b8291bbeaa3c0435198368ccf2b11fa8cca02e5e115"
+            return None
 
+        artist = None
         try:
-            data.artist = tags.get('TPE1').text[0]
+            artist = tags.get('TPE1').text[0]
         except:
             pass
 
-        data.duration = int(tags.info.length)
-
-        return data
-
-    async def get_playlist(self, search: str, include_name: bool = False):
-        await self.refresh_token()
+        picture = None
+        pic_keys = [key for key in tags.keys() if "APIC" in key]
+        if pic_keys:
+            picture = tags.get(pic_keys[0]).data
+
+        return artist, int(tags.info.length), picture
+
+    async def iter_playlist(self, search: str):
+        """Yields the audio files in a folder one page at a time as they arrive from Drive"""
+        drive_v3 = await client.api()
+        page_token = None
+        while True:
+            user_creds = await tokens.get()
+            params = {
+                "q" : f"mimeType contains 'audio' and '{search}' in parents",
+                "fields" : 'files(name,id),nextPageToken',
+                "orderBy" : 'folder,name,createdTime',
+                "pageSize" : 1000,
+                "supportsAllDrives" : True,
+                "includeItemsFromAllDrives" : True
+            }
+            if page_token:
+                params['pageToken'] = page_token
+
+            data = await client.as_user(drive_v3.files.list(**params), user_creds)
+            if data is None:
+                raise GDriveError('Couldn\'t find anything that matches `{}`'.format(search))
+
+            yield data['files']
+
+            page_token = data.get('nextPageToken')
+            if not page_token:
+                break
+
+    async def list_folder(self, search: str):
+        """Returns every audio file in a folder.
+        The listing is cached on disk and kept current by replaying the Drive changes feed,
+        so listing the same folder again only costs a small delta request.
+        """
+
+        lock = self.listing_locks.setdefault(search, asyncio.Lock())
+        async with lock:
+            loop = asyncio.get_event_loop()
+            listing = self.listings.get(search)
+            if listing is None:
+                listing = await loop.run_in_executor(None, self.load_listing, search)
+
+            if listing is None:
+                listing = await self.full_listing(search)
+                changed = True
+            else:
+                changed = await self.sync_listing(search, listing)
+            self.listings[search] = listing
+
+            # An unchanged listing isn't rewritten, on the next start its older page token just replays the same changes
+            if changed:
+                await loop.run_in_executor(None, self.save_listing, search, listing)
+
+        return listing['files']
+
+    async def full_listing(self, search: str):
+        user_creds = await tokens.get()
+
+        drive_v3 = await client.api()
+        # Taken before listing so that nothing changed during the listing is missed
+        token_data = await client.as_user(
+            drive_v3.changes.getStartPageToken(supportsAllDrives=True),
+            user_creds
+        )
+
+        files = []
+        async for page in self.iter_playlist(search):
+            files.extend({"id" : entry['id'], "name" : entry['name']} for entry in page)
+
+        return {
+            "start_page_token" : token_data['startPageToken'],
+            "files" : files
+        }
 
-        async with Aiogoogle(user_creds=self.user_creds) as aiogoogle:
-            drive_v3 = await aiogoogle.discover('drive', 'v3')
-            data = await aiogoogle.as_user(
-                drive_v3.files.list(
-                    q=f"mimeType contains 'audio' and '{search}' in parents",
-                    fields='files(name,id),nextPageToken',
-                    orderBy='folder,name,createdTime',
+    async def sync_listing(self, search: str, listing: dict):
+        """Applies the changes made since the listing's page token and returns whether any of them touched the folder"""
+        user_creds = await tokens.get()
+
+        drive_v3 = await client.api()
+        files = {entry['id'] : entry for entry in listing['files']}
+        changed = False
+        page_token = listing['start_page_token']
+        while True:
+            data = await client.as_user(
+                drive_v3.changes.list(
+                    pageToken=page_token,
+                    fields='nextPageToken,newStartPageToken,changes(fileId,removed,file(name,mimeType,parents,trashed))',
                     pageSize=1000,
                     supportsAllDrives=True,
                     includeItemsFromAllDrives=True
-                )
+                ),
+                user_creds
             )
 
-        if data is None:
-            raise GDriveError('Couldn\'t find anything that matches `{}`'.format(search))
+            for change in data.get('changes', []):
+                file_id = change['fileId']
+                changed_file = change.get('file')
+                in_folder = (
+                    not change.get('removed')
+                    and changed_file is not None
+                    and not changed_file.get('trashed')
+                    and 'audio' in changed_file.get('mimeType', '')
+                    and search in changed_file.get('parents', [])
+                )
+                if in_folder:
+                    files[file_id] = {"id" : file_id, "name" : changed_file['name']}
+                    changed = True
+                elif files.pop(file_id, None) is not None:
+                    changed = True
 
-        sources = []
-        if not include_name:
-            for entry in data['files']:
-                sources.append(entry['id'])
-        else:
-            for entry in data['files']:
-                sources.append({
-                    "id" : entry['id'],
-                    "name" : entry['name']
-                })
+            if 'newStartPageToken' in data:
+                listing['start_page_token'] = data['newStartPageToken']
+                break
+            page_token = data['nextPageToken']
 
-        return sources
+        if changed:
+            listing['files'] = sorted(files.values(), key=lambda entry: entry['name'])
+        return changed
 
-    async def get_playlist_info(self, search: str):
-        await self.refresh_token()
+    @staticmethod
+    def load_listing(search: str):
+        try:
+            with open(LISTING_CACHE.format(search)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
 
-        async with Aiogoogle(user_creds=self.user_creds) as aiogoogle:
-            drive_v3 = await aiogoogle.discover('drive', 'v3')
-            folder_data = await aiogoogle.as_user(
+    @staticmethod
+    def save_listing(search: str, listing: dict):
+        with open(f"{LISTING_CACHE.format(search)}.{WORKER_ID}.tmp", 'w') as f:
+            json.dump(listing, f)
+        os.replace(f"{LISTING_CACHE.format(search)}.{WORKER_ID}.tmp", LISTING_CACHE.format(search))
+
+    async def fetch_playlist(self, search: str):
+        """Fetches a folder's name and listing together"""
+        user_creds = await tokens.get()
+
+        drive_v3 = await client.api()
+        folder_data, files = await asyncio.gather(
+            client.as_user(
                 drive_v3.files.get(
                     fileId=search,
-                    fields='id,name,owners(displayName),createdTime,webViewLink',
+                    fields='id,name',
                     supportsAllDrives=True
-                )
-            )
-
-        async with Aiogoogle(user_creds=self.user_creds) as aiogoogle:
-            drive_v3 = await aiogoogle.discover('drive', 'v3')
-            file_data = await aiogoogle.as_user(
-                drive_v3.files.list(
-                    q=f"mimeType contains 'audio' and '{search}' in parents",
-                    fields='files(name,id),nextPageToken',
-                    orderBy='folder,name,createdTime',
-                    pageSize=1000,
-                    supportsAllDrives=True,
-                    includeItemsFromAllDrives=True
-                )
-            )
-
-        if file_data is None:
-            raise GDriveError('Couldn\'t find anything that matches `{}`'.format(search))
+                ),
+                user_creds
+            ),
+            self.list_folder(search)
+        )
 
+        entries = [{"id" : entry['id'], "name" : entry['name']} for entry in files]
         data = {
             "title" : folder_data['name'],
-            "song_num" : len(file_data['files'])
+            "song_num" : len(entries),
+            "entries" : entries
         }
 
         return data
-
-    async def refresh_token(self):
-        if self.refreshed:
-            time_passed = int(self.refreshed_time - time.time())
-            if time_passed < 2000:
-                return
-
-        async with Aiogoogle(user_creds=self.user_creds, client_creds=self.client_creds) as aiogoogle:
-            creds = await aiogoogle.oauth2.refresh(self.user_creds, self.client_creds)
-        creds['refresh_token'] = self.refreshtoken
-        self.user_creds = creds
-        self.refreshed_time = time.time()
-        self.refreshed = True
-        with open("token.json", 'w') as f:
-            json.dump(creds, f)
@@ -0,0 +1,88 @@
+"""Runs the bot as several processes, each connecting a contiguous range of shards.
+Every process shares config.json and the audio, image and drive caches in the working directory.
+
+    python launcher.py [--processes N] [--shards M]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+# Discord allows one IDENTIFY every 5 seconds for most bots, so processes are started that far apart
+IDENTIFY_INTERVAL = 5
+RESTART_DELAY = 10
+
+def shard_ranges(shard_count: int, processes: int):
+    """Splits shard ids 0..shard_count-1 into `processes` contiguous, evenly sized ranges"""
+    processes = min(processes, shard_count)
+    base, extra = divmod(shard_count, processes)
+    ranges = []
+    start = 0
+    for num in range(processes):
+        end = start + base + (num < extra)
+        ranges.append(list(range(start, end)))
+        start = end
+    return ranges
+
+class Worker:
+
+    def __init__(self, worker_id: int, shard_ids: list, shard_count: int):
+        self.worker_id = worker_id
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        self.process = None
+
+    def start(self):
+        env = dict(os.environ)
+        env.update(
+            BOT_WORKER_ID=str(self.worker_id),
+            BOT_SHARD_IDS=",".join(str(shard_id) for shard_id in self.shard_ids),
+            BOT_SHARD_COUNT=str(self.shard_count)
+        )
+        self.process = subprocess.Popen([sys.executable, "main.py"], env=env)
+        print(f"Started worker {self.worker_id} (pid {self.process.pid}) with shards {self.shard_ids}")
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+def main():
+    with open('config.json') as f:
+        config = json.load(f)
+
+    parser = argparse.ArgumentParser(description="Runs the bot as several sharded processes")
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--shards', type=int, default=config.get('shard_count'))
+    args = parser.parse_args()
+
+    shard_count = args.shards or args.processes
+    workers = [
+        Worker(worker_id, shard_ids, shard_count)
+        for worker_id, shard_ids in enumerate(shard_ranges(shard_count, args.processes))
+    ]
+
+    try:
+        for worker in workers:
+            worker.start()
+            time.sleep(IDENTIFY_INTERVAL * len(worker.shard_ids))
+
+        while True:
+            time.sleep(RESTART_DELAY)
+            for worker in workers:
+                if worker.process.poll() is not None:
+                    print(f"Worker {worker.worker_id} exited with {worker.process.returncode}, restarting")
+                    worker.start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for worker in workers:
+            worker.stop()
+
+if __name__ == "__main__":
+    main()
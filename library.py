@@ -0,0 +1,133 @@
+import asyncio
+import re
+import unicodedata
+
+from main import INFO
+
+FUZZY_THRESHOLD = 0.5
+
+def normalize(text: str):
+    text = unicodedata.normalize('NFKD', text)
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    text = re.sub(r'[\W_]+', ' ', text.casefold())
+    return text.strip()
+
+def get_trigrams(text: str):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class LibraryIndex:
+    """In memory search index of the configured gdrive folder.
+    Refreshed in the background so that lookups never wait on the Drive API.
+    """
+
+    def __init__(self, gdrive, folder_id: str, refresh_interval: int = 600, loop: asyncio.BaseEventLoop = None):
+
+        self.gdrive = gdrive
+        self.folder_id = folder_id
+        self.refresh_interval = refresh_interval
+        self.loop = loop or asyncio.get_event_loop()
+        self.ready = asyncio.Event()
+
+        self.entries = []
+        self.tokens = {}
+        self.trigrams = {}
+        self.refresher = None
+
+    def start(self):
+        if self.refresher is None:
+            self.refresher = self.loop.create_task(self.refresh_task())
+
+    def stop(self):
+        if self.refresher is not None:
+            self.refresher.cancel()
+            self.refresher = None
+
+    async def refresh_task(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                INFO(f"Failed to refresh library index: {e}")
+            # Searches wait for the first attempt only, a failed one leaves the index empty
+            self.ready.set()
+            await asyncio.sleep(self.refresh_interval)
+
+    async def refresh(self):
+        files = await self.gdrive.list_folder(self.folder_id)
+        entries, tokens, trigrams = await self.loop.run_in_executor(None, self.build, files)
+        self.entries, self.tokens, self.trigrams = entries, tokens, trigrams
+        INFO(f"Indexed {len(entries)} files from library")
+
+    @staticmethod
+    def build(files: list):
+        entries = []
+        tokens = {}
+        trigrams = {}
+        for num, each_file in enumerate(files):
+            normalized = normalize(each_file['name'].rsplit(".", 1)[0])
+            entries.append((each_file['id'], each_file['name'], normalized))
+            for token in set(normalized.split()):
+                tokens.setdefault(token, set()).add(num)
+            for trigram in get_trigrams(normalized):
+                trigrams.setdefault(trigram, set()).add(num)
+
+        return entries, tokens, trigrams
+
+    def search(self, query: str, limit: int = 1):
+        """Returns up to `limit` (id, name) pairs ranked by how well they match the query.
+        Substring matches rank first, then matches containing every word of the query,
+        then fuzzy trigram matches.
+        """
+
+        query = normalize(query)
+        if not query or not self.entries:
+            return []
+
+        ranked = self.substring_matches(query)
+        if not ranked:
+            ranked = self.token_matches(query)
+        if not ranked:
+            ranked = self.fuzzy_matches(query)
+
+        return [self.entries[num][:2] for num in ranked[:limit]]
+
+    def substring_matches(self, query: str):
+        postings = [self.trigrams.get(trigram) for trigram in get_trigrams(query) if trigram[0] != " " and trigram[-1] != " "]
+        if not postings:
+            postings = [self.tokens.get(token) for token in query.split()]
+        if None in postings or not postings:
+            return []
+
+        postings.sort(key=len)
+        candidates = postings[0].intersection(*postings[1:])
+        matches = [num for num in candidates if query in self.entries[num][2]]
+        matches.sort(key=lambda num: (not self.entries[num][2].startswith(query), len(self.entries[num][2]), num))
+        return matches
+
+    def token_matches(self, query: str):
+        postings = [self.tokens.get(token) for token in set(query.split())]
+        if None in postings:
+            return []
+
+        postings.sort(key=len)
+        candidates = postings[0].intersection(*postings[1:])
+        return sorted(candidates, key=lambda num: (len(self.entries[num][2]), num))
+
+    def fuzzy_matches(self, query: str):
+        query_trigrams = get_trigrams(query)
+        postings = sorted((self.trigrams.get(trigram, set()) for trigram in query_trigrams), key=len)
+        # A close enough entry shares at least half of the query's trigrams, so it has to be in one of the rarest postings
+        needed = (len(postings) + 1) // 2
+        candidates = set().union(*postings[:len(postings) - needed + 1])
+
+        scored = []
+        for num in candidates:
+            shared = sum(num in posting for posting in postings)
+            entry_size = len(self.entries[num][2]) + 1
+            similarity = shared / (len(query_trigrams) + entry_size - shared)
+            if similarity >= FUZZY_THRESHOLD:
+                scored.append((-similarity, num))
+
+        scored.sort()
+        return [num for _, num in scored]
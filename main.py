@@ -1,3 +1,5 @@
+import os
+import sys
 import json
 
 import discord
@@ -11,7 +13,23 @@ with open('config.json') as f:
 
 INFO = logger.info
 DEBUG = logger.debug
-bot = commands.Bot(command_prefix=config["prefix"], description="Music Bot")
+
+# Set by launcher.py for each process it starts, the id keeps temporary files of processes sharing the caches apart
+WORKER_ID = os.environ.get('BOT_WORKER_ID', '0')
+SHARD_IDS = os.environ.get('BOT_SHARD_IDS')
+SHARD_COUNT = os.environ.get('BOT_SHARD_COUNT')
+
+if SHARD_IDS:
+    bot = commands.AutoShardedBot(
+        command_prefix=config["prefix"],
+        description="Music Bot",
+        shard_ids=[int(shard_id) for shard_id in SHARD_IDS.split(",")],
+        shard_count=int(SHARD_COUNT)
+    )
+elif config.get('sharded', False):
+    bot = commands.AutoShardedBot(command_prefix=config["prefix"], description="Music Bot", shard_count=config.get('shard_count'))
+else:
+    bot = commands.Bot(command_prefix=config["prefix"], description="Music Bot")
 
 @bot.event
 async def on_ready():
@@ -21,7 +39,11 @@ async def on_ready():
     bot.add_cog(music.Music(bot))
 
 def main():
-    bot.run(config['token'])
+    if "--download-service" in sys.argv:
+        import download_service
+        download_service.main()
+    else:
+        bot.run(config['token'])
 
 def load_file(filename, skip_commented_lines=True, comment_char='#'):
     try:
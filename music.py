@@ -5,6 +5,9 @@ import discord
 from discord.ext import commands
 
 import SourceDL
+import cache
+import ffmpeg_pool
+import gdrive
 import voice
 from main import INFO, config
 
@@ -12,12 +15,13 @@ class Music(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
         self.voice_states = {}
+        self.backends = SourceDL.Backends(bot.loop)
 
     def get_voice_state(self, ctx: commands.Context):
         """Returns or creates voice.VoiceState for the guild defined in the passed ctx"""
         state = self.voice_states.get(ctx.guild.id)
         if not state or not state.exists:
-            state = voice.VoiceState(self.bot, ctx)
+            state = voice.VoiceState(self.bot, ctx, self.backends)
             self.voice_states[ctx.guild.id] = state
 
         return state
@@ -26,6 +30,14 @@ class Music(commands.Cog):
         """Unloads the music cog"""
         for state in self.voice_states.values():
             self.bot.loop.create_task(state.stop())
+        if self.backends.library:
+            self.backends.library.stop()
+        self.backends.ffmpeg_pool.stop()
+        if self.backends.download_service:
+            self.bot.loop.create_task(self.backends.download_service.close())
+        self.bot.loop.create_task(gdrive.client.close())
+        self.backends.audio_cache.save()
+        self.backends.image_cache.save()
 
     def cog_check(self, ctx: commands.Context):
         """Prevent calling commands in DM's"""
@@ -99,6 +111,27 @@ class Music(commands.Cog):
         ctx.voice_state.volume = volume / 100
         await ctx.send('Volume of the player set to {}%'.format(volume))
 
+    @commands.command(name='cache')
+    @commands.is_owner()
+    async def _cache(self, ctx: commands.Context):
+        """Shows usage and hit rate of the caches and how long track transitions take."""
+
+        await ctx.message.delete(delay=5)
+        description = '\n'.join([
+            cache.format_stats('Audio', self.backends.audio_cache.stats()),
+            cache.format_stats('Images', self.backends.image_cache.stats()),
+            cache.format_metadata_stats('YouTube metadata', self.backends.metadata.stats()),
+            f"YouTube extractor calls: {self.backends.youtube.extract_calls}",
+            ffmpeg_pool.format_stats(self.backends.ffmpeg_pool.stats())
+        ])
+        transitions = sorted(ctx.voice_state.transitions)
+        if transitions:
+            description += (
+                f"\nTrack transitions: median {transitions[len(transitions) // 2] * 1000:.0f} ms, "
+                f"worst {transitions[-1] * 1000:.0f} ms over the last {len(transitions)}"
+            )
+        await ctx.send(embed=discord.Embed(description=description), delete_after=30)
+
     @commands.command(name='now', aliases=['current', 'playing', 'np', 'nowplaying'])
     async def _now(self, ctx: commands.Context):
         """Displays the currently playing song."""
@@ -130,7 +163,9 @@ class Music(commands.Cog):
     async def _stop(self, ctx: commands.Context):
         """Stops playing song and clears the queue."""
 
+        ctx.voice_state.cancel_imports()
         ctx.voice_state.songs.clear()
+        ctx.voice_state.queue_changed()
         await ctx.message.delete(delay=5)
 
         if ctx.voice_state.is_playing:
@@ -157,26 +192,26 @@ class Music(commands.Cog):
         """
 
         await ctx.message.delete(delay=5)
-        song_queue = voice.SongQueue()
-        await song_queue.put(ctx.voice_state.current)
-        for song in ctx.voice_state.songs:
-            await song_queue.put(song)
-        if len(song_queue) == 0:
+        # The current song is shown as the first entry, ahead of the queue itself
+        current = [ctx.voice_state.current] if ctx.voice_state.current else []
+        total = len(current) + len(ctx.voice_state.songs)
+        if total == 0:
             return await ctx.send('Empty queue.', delete_after=5)
 
         items_per_page = 10
-        pages = math.ceil(len(song_queue) / items_per_page)
+        pages = math.ceil(total / items_per_page)
 
         start = (page - 1) * items_per_page
         end = start + items_per_page
 
+        songs = current[start:end] + ctx.voice_state.songs.page(max(start - len(current), 0), end - len(current))
         queue = ''
-        for i, song in enumerate(song_queue[start:end], start=start):
+        for i, song in enumerate(songs, start=start):
             queue += f'`{i+1}.` [**{song.source.data.title}**]({song.source.data.webpage_url})\n'
 
         embed = (
             discord.Embed(
-                description='**{} tracks:**\n\n{}'.format(len(song_queue), queue)
+                description='**{} tracks:**\n\n{}'.format(total, queue)
             )
             .set_footer(text='Viewing page {}/{}'.format(page, pages))
         )
@@ -199,8 +234,8 @@ class Music(commands.Cog):
         end = start + items_per_page
 
         queue = ''
-        for i, song in enumerate(ctx.voice_state.song_history[start:end], start=start):
-            queue += f'`{i+1}.` [**{song.source.data.title}**]({song.source.data.webpage_url})\n'
+        for i, entry in enumerate(ctx.voice_state.song_history.page(start, end), start=start):
+            queue += f'`{i+1}.` [**{entry.title}**]({entry.webpage_url})\n'
 
         embed = (
             discord.Embed(
@@ -219,6 +254,7 @@ class Music(commands.Cog):
             return await ctx.send('Empty queue.', delete_after=5)
 
         ctx.voice_state.songs.shuffle()
+        ctx.voice_state.queue_changed()
 
     @commands.command(name='remove')
     async def _remove(self, ctx: commands.Context, index: int):
@@ -229,6 +265,18 @@ class Music(commands.Cog):
             return await ctx.send('Empty queue.', delete_after=5)
 
         ctx.voice_state.songs.remove(index - 1)
+        ctx.voice_state.queue_changed()
+
+    @commands.command(name='move', aliases=['mv'])
+    async def _move(self, ctx: commands.Context, index: int, new_index: int):
+        """Moves a song in the queue from one index to another."""
+
+        await ctx.message.delete(delay=5)
+        if len(ctx.voice_state.songs) == 0:
+            return await ctx.send('Empty queue.', delete_after=5)
+
+        ctx.voice_state.songs.move(index - 1, new_index - 1)
+        ctx.voice_state.queue_changed()
 
     @commands.command(name='loop')
     async def _loop(self, ctx: commands.Context):
@@ -285,53 +333,56 @@ class Music(commands.Cog):
         """
 
         async with ctx.typing():
-            parsed_search = await SourceDL.parse_search(ctx, search, self.bot.loop)
+            parsed_search = await SourceDL.parse_search(ctx, search, self.backends, self.bot.loop)
             song_url, source_type, playlist = SourceDL.get_type(parsed_search)
-            source_init = SourceDL.Source(ctx, source_type=source_type, loop=self.bot.loop)
+            source_init = SourceDL.Source(ctx, source_type=source_type, backends=self.backends, loop=self.bot.loop)
 
             if playlist:
-                playlist_info = await source_init.get_playlist_info(song_url)
-                playlist_message = await ctx.send(f'Queuing {playlist_info.title}')
                 try:
-                    sources = await source_init.get_playlist(song_url)
+                    playlist_data = await source_init.get_playlist(song_url)
                 except SourceDL.SourceError as e:
                     await ctx.send('An error occurred while processing this request: {}'.format(str(e)))
                     return
             else:
-                sources = [song_url]
-
-            for source_num, each_source in enumerate(sources):
                 try:
-                    source = await source_init.create_source(each_source)
+                    source = await source_init.create_source(song_url)
                 except SourceDL.SourceError as e:
                     await ctx.send('An error occurred while processing this request: {}'.format(str(e)))
-                    continue
-                else:
-                    if not ctx.voice_state.voice:
-                        await ctx.invoke(self._join)
+                    return
 
-                    song = voice.Song(source)
-                    await ctx.voice_state.songs.put(song)
-                    sources[source_num] = source
+            if not ctx.voice_state.voice:
+                await ctx.invoke(self._join)
 
             color_list = [c for c in voice.colors.values()]
             if playlist:
+                # Playback starts on the first track while the rest are resolved in the background
+                placeholders = list(source_init.iter_placeholders(playlist_data))
+                for placeholder in placeholders:
+                    ctx.voice_state.songs.put_nowait(voice.Song(placeholder))
+
                 embed = (
                     discord.Embed(
-                        description=f'Enqueued {playlist_info.song_num} songs from {playlist_info.title} by {ctx.author.name}',
+                        description=f'Enqueued {playlist_data.song_num} songs from {playlist_data.title} by {ctx.author.name}',
                         color=random.choice(color_list)
                     )
                 )
-                playlist_message.delete()
             else:
+                song = voice.Song(source)
+                ctx.voice_state.songs.put_nowait(song)
+
                 embed = (
                     discord.Embed(
-                        description=f'Enqueued {sources[0].data.title} by {ctx.author.name}',
+                        description=f'Enqueued {source.data.title} by {ctx.author.name}',
                         color=random.choice(color_list)
                     )
                 )
+            ctx.voice_state.queue_changed()
 
-            await ctx.send(embed=embed, delete_after=10)
+            if playlist and ctx.voice_state.playlist_concurrency > 0 and ctx.voice_state.playlist_resolve_window > 0:
+                message = await ctx.send(embed=embed)
+                ctx.voice_state.start_import(source_init, placeholders, message, embed)
+            else:
+                await ctx.send(embed=embed, delete_after=10)
             await ctx.message.delete(delay=10)
 
     @_play.before_invoke
@@ -0,0 +1,33 @@
+import os
+import sys
+import shutil
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# main reads config.json from the working directory when it is imported, so the tests run from a scratch copy
+WORKDIR = tempfile.mkdtemp(prefix="musicbot-tests-")
+shutil.copy(os.path.join(ROOT, "config-example.json"), os.path.join(WORKDIR, "config.json"))
+for directory in ("audio_cache", "image_cache", "drive_cache"):
+    os.mkdir(os.path.join(WORKDIR, directory))
+os.chdir(WORKDIR)
+
+import pytest
+
+# music has to be imported before main, SourceDL or gdrive
+import music
+import SourceDL
+
+@pytest.fixture
+def make_data():
+    """Builds track data for a downloaded YouTube track, keyword arguments replace its fields"""
+    def make(**info):
+        fields = {"title" : "Title", "search" : "search", "artist" : "Unknown", "duration" : 1, "expected_filename" : "youtube-abc.m4a"}
+        fields.update(info)
+        return SourceDL.DataClass(**fields)
+    return make
+
+def pytest_unconfigure(config):
+    os.chdir(ROOT)
+    shutil.rmtree(WORKDIR, ignore_errors=True)
@@ -0,0 +1,96 @@
+import asyncio
+import random
+
+import pytest
+
+import blocklist
+import voice
+from blocklist import BlockList
+
+@pytest.fixture(autouse=True)
+def small_blocks(monkeypatch):
+    # Small blocks make a few hundred items split and merge blocks like a huge queue would
+    monkeypatch.setattr(blocklist, "BLOCK_SIZE", 4)
+
+def test_matches_list_under_random_operations():
+    random.seed(0)
+    items = list(range(50))
+    queue = BlockList(items)
+    for step in range(3000):
+        action = random.choice(("append", "insert", "pop", "popleft", "move", "getitem", "delitem"))
+        if action == "append":
+            items.append(step)
+            queue.append(step)
+        elif action == "insert":
+            index = random.randint(-len(items) - 2, len(items) + 2)
+            items.insert(index, step)
+            queue.insert(index, step)
+        elif not items:
+            continue
+        elif action == "pop":
+            index = random.randint(-len(items), len(items) - 1)
+            assert queue.pop(index) == items.pop(index)
+        elif action == "popleft":
+            assert queue.popleft() == items.pop(0)
+        elif action == "move":
+            index, new_index = random.randrange(len(items)), random.randrange(len(items))
+            items.insert(new_index, items.pop(index))
+            queue.move(index, new_index)
+        elif action == "getitem":
+            index = random.randint(-len(items), len(items) - 1)
+            assert queue[index] == items[index]
+        else:
+            index = random.randrange(len(items))
+            del items[index]
+            del queue[index]
+        assert len(queue) == len(items)
+    assert list(queue) == items
+
+def test_out_of_range():
+    queue = BlockList(range(10))
+    for index in (10, -11):
+        with pytest.raises(IndexError):
+            queue[index]
+    with pytest.raises(IndexError):
+        BlockList().pop()
+
+def test_page_and_slices():
+    items = list(range(100))
+    queue = BlockList(items)
+    assert queue.page(10, 20) == items[10:20]
+    assert queue.page(95, 120) == items[95:]
+    assert queue.page(-5, 3) == items[:3]
+    assert queue.page(50, 40) == []
+    assert queue[7:33] == items[7:33]
+    assert queue[::7] == items[::7]
+    assert queue[-3:] == items[-3:]
+
+def test_clear_and_shuffle():
+    queue = BlockList(range(100))
+    queue.shuffle()
+    assert sorted(queue) == list(range(100))
+    assert queue[42] in range(100)
+    queue.clear()
+    assert len(queue) == 0 and list(queue) == []
+    queue.append("a")
+    assert queue[0] == "a"
+
+def test_song_queue_keeps_queue_semantics():
+    async def run():
+        queue = voice.SongQueue()
+        for num in range(20):
+            await queue.put(num)
+        queue.move(19, 0)
+        queue.remove(1)
+        assert len(queue) == 19
+        assert queue[0] == 19 and queue.page(0, 3) == [19, 1, 2]
+        assert [await queue.get() for _ in range(3)] == [19, 1, 2]
+
+        getter = asyncio.ensure_future(queue.get())
+        queue.clear()
+        await asyncio.sleep(0)
+        assert not getter.done()
+        await queue.put("next")
+        assert await asyncio.wait_for(getter, 1) == "next"
+
+    asyncio.get_event_loop().run_until_complete(run())
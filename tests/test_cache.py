@@ -0,0 +1,50 @@
+import os
+import time
+import sqlite3
+
+import cache
+
+def make_cache(tmp_path, monkeypatch):
+    os.mkdir(tmp_path / "cache")
+    monkeypatch.chdir(tmp_path)
+    audio_cache = cache.CacheManager("cache", max_bytes=10 ** 9, max_entries=100)
+    with open(audio_cache.path("a.opus"), 'wb') as f:
+        f.write(b"audio")
+    audio_cache.add("a.opus")
+    return audio_cache
+
+def test_lookup_does_not_wait_for_another_writer(tmp_path, monkeypatch):
+    audio_cache = make_cache(tmp_path, monkeypatch)
+    used = audio_cache.lookup("a.opus")['last_used']
+
+    # Another process in the middle of a long write, like an add evicting a lot of files
+    other = sqlite3.connect(audio_cache.path("index.db"), isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")
+    try:
+        start = time.monotonic()
+        for _ in range(100):
+            assert audio_cache.lookup("a.opus") is not None
+        assert audio_cache.lookup("b.opus") is None
+        assert time.monotonic() - start < 1
+
+        # A flush against the busy index keeps the batch for later instead of raising
+        monkeypatch.setattr(cache, "FLUSH_INTERVAL", -1)
+        audio_cache.db.execute("PRAGMA busy_timeout = 10")
+        audio_cache.lookup("a.opus")
+        assert audio_cache.counts == {"hits" : 102, "misses" : 1}
+    finally:
+        other.rollback()
+        other.close()
+
+    audio_cache.save()
+    assert audio_cache.counts == {} and audio_cache.uses == {}
+    stats = audio_cache.stats()
+    assert (stats['hits'], stats['misses']) == (102, 1)
+    assert audio_cache.db.execute("SELECT last_used FROM files WHERE name = 'a.opus'").fetchone()[0] > used
+
+def test_stats_include_unflushed_counts(tmp_path, monkeypatch):
+    audio_cache = make_cache(tmp_path, monkeypatch)
+    audio_cache.lookup("a.opus")
+    audio_cache.lookup("missing.opus")
+    stats = audio_cache.stats()
+    assert (stats['hits'], stats['misses'], stats['hit_rate']) == (1, 1, 0.5)
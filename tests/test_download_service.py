@@ -0,0 +1,142 @@
+import os
+import sys
+import asyncio
+import subprocess
+
+import pytest
+
+import SourceDL
+import download_service
+
+class FakeBackends:
+    """Stands in for the extractors, each download reports progress and finishes when released"""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.calls = []
+        self.release = asyncio.Event()
+
+    async def download(self, source_type: str, data: SourceDL.DataClass, progress=None):
+        self.calls.append(data.expected_filename)
+        progress(1, 4)
+        await self.release.wait()
+        progress(4, 4)
+        if data.title == "broken":
+            raise SourceDL.SourceError('Couldn\'t download `{}`'.format(data.title))
+        data.duration = 123
+        return data
+
+async def start(loop):
+    backends = FakeBackends(loop)
+    server = download_service.DownloadServer(backends, 0, loop)
+    await server.start()
+    port = server.server.sockets[0].getsockname()[1]
+    return backends, server, download_service.DownloadClient(port, spawn=False, loop=loop)
+
+def test_round_trip_dedupes_and_reports_progress(monkeypatch, make_data):
+    monkeypatch.setattr(download_service, "PROGRESS_INTERVAL", 0)
+
+    async def run(loop):
+        backends, server, client = await start(loop)
+        other_client = download_service.DownloadClient(client.port, spawn=False, loop=loop)
+        reports = []
+        try:
+            fetches = [
+                loop.create_task(client.fetch("YouTube", make_data(title="song", expected_filename="youtube-a.m4a"), lambda *args: reports.append(args))),
+                loop.create_task(other_client.fetch("YouTube", make_data(title="song", expected_filename="youtube-a.m4a"))),
+                loop.create_task(client.fetch("YouTube", make_data(title="broken", expected_filename="youtube-b.m4a")))
+            ]
+            while len(backends.calls) < 2 or not reports:
+                await asyncio.sleep(0.01)
+            backends.release.set()
+            first, second, broken = await asyncio.wait_for(asyncio.gather(*fetches, return_exceptions=True), 5)
+
+            assert first["duration"] == second["duration"] == 123
+            assert isinstance(broken, download_service.DownloadServiceError)
+            assert "broken" in str(broken)
+            assert sorted(backends.calls) == ["youtube-a.m4a", "youtube-b.m4a"]
+            assert server.submitted == 2 and server.deduped == 1
+            assert reports[0] == (1, 4) and reports[-1] == (4, 4)
+            assert server.jobs == {}
+        finally:
+            await client.close()
+            await other_client.close()
+            server.close()
+            await server.server.wait_closed()
+            # Lets the transports finish closing before the loop does
+            await asyncio.sleep(0.05)
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(run(loop))
+    finally:
+        loop.close()
+
+def test_rejects_names_outside_the_cache(make_data):
+    async def run(loop):
+        backends, server, client = await start(loop)
+        try:
+            for filename in ("../main.py", "..\\token.json", "/etc/passwd", "C:token.json", ""):
+                with pytest.raises(download_service.DownloadServiceError, match="Refusing"):
+                    await asyncio.wait_for(client.fetch("YouTube", make_data(expected_filename=filename)), 5)
+            assert backends.calls == [] and server.jobs == {}
+        finally:
+            await client.close()
+            server.close()
+            await server.server.wait_closed()
+            await asyncio.sleep(0.05)
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(run(loop))
+    finally:
+        loop.close()
+
+def test_unreachable_service_raises_unavailable(make_data):
+    async def run(loop):
+        backends, server, client = await start(loop)
+        server.close()
+        await server.server.wait_closed()
+        with pytest.raises(download_service.ServiceUnavailable):
+            await client.fetch("YouTube", make_data(title="song", expected_filename="youtube-a.m4a"))
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(run(loop))
+    finally:
+        loop.close()
+
+def test_spawned_service_runs_as_its_own_worker(monkeypatch):
+    started = {}
+
+    class FakePopen:
+        def __init__(self, args, env=None):
+            started.update(args=args, env=env)
+
+        def poll(self):
+            return None
+
+    monkeypatch.setattr(subprocess, "Popen", FakePopen)
+    monkeypatch.setenv("BOT_WORKER_ID", "3")
+    monkeypatch.setenv("BOT_SHARD_IDS", "6,7")
+    monkeypatch.setenv("BOT_SHARD_COUNT", "8")
+
+    async def run(loop):
+        client = download_service.DownloadClient(1, loop=loop)
+        with pytest.raises(download_service.ServiceUnavailable):
+            await client.start_service()
+
+    async def no_wait(delay: float):
+        pass
+    # Nothing listens on port 1, so this only skips the wait for the service to come up
+    monkeypatch.setattr(asyncio, "sleep", no_wait)
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(run(loop))
+    finally:
+        loop.close()
+
+    assert started["args"] == [sys.executable, "main.py", "--download-service"]
+    assert started["env"]["BOT_WORKER_ID"] == "service"
+    assert "BOT_SHARD_IDS" not in started["env"] and "BOT_SHARD_COUNT" not in started["env"]
+    assert started["env"]["PATH"] == os.environ["PATH"]
@@ -0,0 +1,141 @@
+import os
+import asyncio
+import hashlib
+
+import aiohttp.web
+import pytest
+
+import cache
+import gdrive
+from main import WORKER_ID
+
+CONTENT = bytes(range(256)) * 14
+
+class FakeDrive:
+    """Serves CONTENT over ranged requests the way Drive's media endpoint does, with faults switched on per test"""
+
+    def __init__(self):
+        self.requests = []
+        self.truncate = 0
+        self.ignore_range = False
+        self.failures = []
+        self.content = CONTENT
+
+    async def handle(self, request: aiohttp.web.Request):
+        self.requests.append(request.headers.get("Range"))
+        if self.failures:
+            return aiohttp.web.Response(status=self.failures.pop(0))
+
+        start, end = (int(num) for num in request.headers["Range"][len("bytes="):].split("-"))
+        if self.ignore_range:
+            return aiohttp.web.Response(status=200, body=self.content)
+        if start >= len(self.content):
+            return aiohttp.web.Response(status=416)
+
+        body = self.content[start:end + 1]
+        if self.truncate:
+            # Promises the whole range and drops the connection partway through
+            self.truncate -= 1
+            response = aiohttp.web.StreamResponse(status=206)
+            response.content_length = len(body)
+            await response.prepare(request)
+            await response.write(body[:len(body) // 2])
+            request.transport.close()
+            return response
+        return aiohttp.web.Response(status=206, body=body)
+
+@pytest.fixture
+def drive(monkeypatch):
+    async def get():
+        return {"access_token" : "token"}
+    monkeypatch.setattr(gdrive.tokens, "get", get)
+    return FakeDrive()
+
+def run_against(drive: FakeDrive, monkeypatch, scenario):
+    async def run():
+        app = aiohttp.web.Application()
+        app.router.add_get("/{file_id}", drive.handle)
+        runner = aiohttp.web.AppRunner(app)
+        await runner.setup()
+        site = aiohttp.web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        monkeypatch.setattr(gdrive, "MEDIA_URL", f"http://127.0.0.1:{port}/{{}}")
+
+        source = gdrive.GDriveSource(cache.CacheManager("audio_cache", 10 ** 9, 1000), None)
+        source.chunk_size = 1000
+        source.backoff_cap = 0
+        try:
+            return await scenario(source)
+        finally:
+            await gdrive.client.close()
+            await runner.cleanup()
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(run())
+    finally:
+        loop.close()
+
+def download(drive: FakeDrive, monkeypatch, make_data, **info):
+    fields = {"search" : "file", "expected_filename" : "gdrive-file.mp3", "size" : len(CONTENT), "checksum" : hashlib.md5(CONTENT).hexdigest()}
+    fields.update(info)
+    data = make_data(**fields)
+
+    async def scenario(source):
+        path = source.audio_cache.path(data.expected_filename)
+        try:
+            await source.download_file(data)
+            with open(path, 'rb') as f:
+                return f.read()
+        finally:
+            assert not os.path.exists(f"{path}.{WORKER_ID}.part")
+            if os.path.exists(path):
+                os.remove(path)
+    return run_against(drive, monkeypatch, scenario)
+
+def test_downloads_in_ranged_chunks(drive, monkeypatch, make_data):
+    assert download(drive, monkeypatch, make_data) == CONTENT
+    assert drive.requests == ["bytes=0-999", "bytes=1000-1999", "bytes=2000-2999", "bytes=3000-3999"]
+
+def test_resumes_after_a_truncated_body(drive, monkeypatch, make_data):
+    drive.truncate = 2
+    assert download(drive, monkeypatch, make_data) == CONTENT
+    # Each retry starts from the bytes that made it into the .part file
+    assert drive.requests[:3] == ["bytes=0-999", "bytes=500-1499", "bytes=1000-1999"]
+
+def test_retries_rate_limits_and_server_errors(drive, monkeypatch, make_data):
+    drive.failures = [429, 503]
+    assert download(drive, monkeypatch, make_data) == CONTENT
+    assert drive.requests[:3] == ["bytes=0-999"] * 3
+
+def test_ignored_range_restarts_the_file(drive, monkeypatch, make_data):
+    drive.ignore_range = True
+    assert download(drive, monkeypatch, make_data) == CONTENT
+    assert len(drive.requests) == 1
+
+def test_file_that_shrank_fails(drive, monkeypatch, make_data):
+    drive.content = CONTENT[:2500]
+    with pytest.raises(gdrive.GDriveError, match="changed on Drive"):
+        download(drive, monkeypatch, make_data)
+
+@pytest.mark.parametrize("status", [403, 404])
+def test_permanent_errors_fail_at_once(drive, monkeypatch, make_data, status):
+    drive.failures = [status]
+    with pytest.raises(gdrive.GDriveError, match=f"HTTP {status}"):
+        download(drive, monkeypatch, make_data)
+    assert len(drive.requests) == 1
+
+def test_stream_skips_what_it_already_sent_when_the_range_is_ignored(drive, monkeypatch, make_data):
+    drive.truncate = 1
+    data = make_data(search="file", expected_filename="gdrive-file.mp3", size=len(CONTENT))
+
+    async def scenario(source):
+        received = b""
+        async for chunk in source.iter_media(data):
+            received += chunk
+            if len(received) >= 500:
+                # The retry after the truncated first chunk gets the whole file back
+                drive.ignore_range = True
+        return received
+    assert run_against(drive, monkeypatch, scenario) == CONTENT
@@ -0,0 +1,35 @@
+import asyncio
+
+import SourceDL
+import transcode
+
+def test_concurrent_ingests_share_one_transcode(monkeypatch, make_data):
+    loop = asyncio.get_event_loop()
+    backends = SourceDL.Backends(loop, download_only=True)
+    calls = []
+
+    async def to_opus(source: str, destination: str, bitrate: int = 128):
+        calls.append(source)
+        await asyncio.sleep(0.05)
+        with open(source, 'rb') as f, open(destination, 'wb') as out:
+            out.write(f.read())
+        return True
+    monkeypatch.setattr(transcode, "to_opus", to_opus)
+
+    with open(backends.audio_cache.path("gdrive-abc.mp3"), 'wb') as f:
+        f.write(b"audio")
+    backends.audio_cache.add("gdrive-abc.mp3", title="Title")
+
+    async def scenario():
+        first, second = make_data(expected_filename="gdrive-abc.mp3"), make_data(expected_filename="gdrive-abc.mp3")
+        await asyncio.gather(backends.ingest(first), backends.ingest(second))
+        # A play arriving after the transcode finished picks up the opus copy instead of transcoding again
+        third = make_data(expected_filename="gdrive-abc.mp3")
+        await backends.ingest(third)
+        return first, second, third
+
+    datas = loop.run_until_complete(scenario())
+    assert len(calls) == 1
+    assert [data.expected_filename for data in datas] == ["gdrive-abc.opus"] * 3
+    assert backends.audio_cache.lookup("gdrive-abc.mp3") is None
+    assert backends.ingesting == {}
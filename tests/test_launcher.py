@@ -0,0 +1,74 @@
+import os
+import sys
+import json
+import subprocess
+
+import cache
+import launcher
+
+def test_shard_ranges_cover_every_shard_once():
+    for shard_count in range(1, 40):
+        for processes in range(1, 12):
+            ranges = launcher.shard_ranges(shard_count, processes)
+            assert len(ranges) == min(processes, shard_count)
+            assert [shard_id for shard_ids in ranges for shard_id in shard_ids] == list(range(shard_count))
+            sizes = [len(shard_ids) for shard_ids in ranges]
+            assert min(sizes) >= 1 and max(sizes) - min(sizes) <= 1
+
+def test_worker_passes_its_shards(tmp_path, monkeypatch):
+    (tmp_path / "main.py").write_text(
+        "import os, json\n"
+        "with open('env.json', 'w') as f:\n"
+        "    json.dump({key : os.environ.get(key) for key in ('BOT_WORKER_ID', 'BOT_SHARD_IDS', 'BOT_SHARD_COUNT')}, f)\n"
+    )
+    monkeypatch.chdir(tmp_path)
+    worker = launcher.Worker(2, [4, 5], 8)
+    worker.start()
+    assert worker.process.wait(timeout=30) == 0
+    worker.stop()
+    with open(tmp_path / "env.json") as f:
+        assert json.load(f) == {"BOT_WORKER_ID" : "2", "BOT_SHARD_IDS" : "4,5", "BOT_SHARD_COUNT" : "8"}
+
+CACHE_WORKER = """
+import os, sys, json
+sys.path.insert(0, sys.argv[1])
+import cache
+
+worker = sys.argv[2]
+audio_cache = cache.CacheManager("cache", max_bytes=10 ** 9, max_entries=50)
+protected = []
+for num in range(40):
+    name = f"{worker}-{num}.opus"
+    with open(audio_cache.path(name), "wb") as f:
+        f.write(os.urandom(1000))
+    audio_cache.add(name)
+    if num % 5 == 0:
+        audio_cache.pin(name)
+        # Only a pin taken while the file was still cached has to keep it
+        if audio_cache.lookup(name) is not None:
+            protected.append(name)
+print(json.dumps(protected))
+"""
+
+def test_processes_share_one_cache(tmp_path, monkeypatch):
+    os.mkdir(tmp_path / "cache")
+    monkeypatch.chdir(tmp_path)
+    root = os.path.dirname(os.path.abspath(launcher.__file__))
+    processes = [
+        subprocess.Popen([sys.executable, "-c", CACHE_WORKER, root, str(worker)], stdout=subprocess.PIPE)
+        for worker in range(4)
+    ]
+    protected = []
+    for process in processes:
+        output, _ = process.communicate(timeout=120)
+        assert process.returncode == 0
+        protected += json.loads(output)
+
+    audio_cache = cache.CacheManager("cache", max_bytes=10 ** 9, max_entries=50)
+    rows = {row['name'] for row in audio_cache.db.execute("SELECT name FROM files")}
+    written = [f"{worker}-{num}.opus" for worker in range(4) for num in range(40)]
+    # Every file is either still indexed or was evicted from disk too, never one without the other
+    assert all(os.path.isfile(audio_cache.path(name)) == (name in rows) for name in written)
+    assert audio_cache.totals() == (len(rows), 1000 * len(rows))
+    assert len(rows) <= 50
+    assert protected and set(protected) <= rows
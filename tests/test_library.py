@@ -0,0 +1,72 @@
+import asyncio
+
+import library
+import SourceDL
+
+FILES = [
+    {"id" : "1", "name" : "Nightcore - Angel With A Shotgun.mp3"},
+    {"id" : "2", "name" : "Angel.mp3"},
+    {"id" : "3", "name" : "Pokémon Theme (TV Size).mp3"},
+    {"id" : "4", "name" : "shotgun_angel_remix.mp3"},
+    {"id" : "5", "name" : "Through the Fire and Flames.mp3"}
+]
+
+class FakeDrive:
+
+    def __init__(self, files: list):
+        self.files = files
+        self.calls = 0
+
+    async def list_folder(self, folder_id: str):
+        self.calls += 1
+        return self.files
+
+def make_index(files: list = FILES):
+    index = library.LibraryIndex(None, "folder")
+    index.entries, index.tokens, index.trigrams = index.build(files)
+    return index
+
+def test_normalize():
+    assert library.normalize("Pokémon  Theme_(TV Size)") == "pokemon theme tv size"
+
+def test_substring_match_prefers_prefix_then_shorter_names():
+    index = make_index()
+    assert index.search("angel", limit=3) == [
+        ("2", "Angel.mp3"),
+        ("4", "shotgun_angel_remix.mp3"),
+        ("1", "Nightcore - Angel With A Shotgun.mp3")
+    ]
+
+def test_substring_match_ignores_accents_and_case():
+    assert make_index().search("POKEMON") == [("3", "Pokémon Theme (TV Size).mp3")]
+
+def test_falls_back_to_matching_every_word():
+    assert make_index().search("shotgun nightcore") == [("1", "Nightcore - Angel With A Shotgun.mp3")]
+
+def test_falls_back_to_fuzzy_matching():
+    assert make_index().search("through the fire and flame") == [("5", "Through the Fire and Flames.mp3")]
+    assert make_index().search("through the fyre and flames") == [("5", "Through the Fire and Flames.mp3")]
+
+def test_no_match_and_empty_index():
+    assert make_index().search("zzzz") == []
+    assert make_index([]).search("angel") == []
+
+def test_refresh_lists_the_folder_once():
+    drive = FakeDrive(FILES)
+    index = library.LibraryIndex(drive, "folder")
+    asyncio.get_event_loop().run_until_complete(index.refresh())
+
+    for _ in range(10):
+        index.search("angel")
+    assert drive.calls == 1
+    assert len(index.entries) == len(FILES)
+
+def test_parse_search_falls_back_while_the_index_is_cold(monkeypatch):
+    monkeypatch.setitem(SourceDL.config, "library_wait", 0.01)
+    backends = SourceDL.Backends.__new__(SourceDL.Backends)
+    backends.library = make_index()
+
+    loop = asyncio.get_event_loop()
+    assert loop.run_until_complete(SourceDL.parse_search(None, "angel", backends)) == "angel"
+    backends.library.ready.set()
+    assert loop.run_until_complete(SourceDL.parse_search(None, "angel", backends)) == "https://drive.google.com/file/d/2/view"
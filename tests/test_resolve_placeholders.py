@@ -0,0 +1,55 @@
+import asyncio
+import random
+
+import SourceDL
+
+class FakeSource:
+
+    def __init__(self, num: int, fail: bool = False):
+        self.num = num
+        self.fail = fail
+        self.data = SourceDL.DataClass(search=str(num))
+
+    async def resolve(self):
+        FakeSource.running += 1
+        FakeSource.peak = max(FakeSource.peak, FakeSource.running)
+        try:
+            await asyncio.sleep(random.uniform(0, 0.01))
+            if self.fail:
+                raise SourceDL.SourceError('Couldn\'t fetch `{}`'.format(self.num))
+        finally:
+            FakeSource.running -= 1
+
+def make_source_init(loop):
+    source_init = SourceDL.Source.__new__(SourceDL.Source)
+    source_init.loop = loop
+    return source_init
+
+def test_yields_in_order_with_bounded_concurrency():
+    FakeSource.running = FakeSource.peak = 0
+    loop = asyncio.get_event_loop()
+    sources = [FakeSource(num, fail=num % 7 == 3) for num in range(50)]
+
+    async def collect():
+        return [item async for item in make_source_init(loop).resolve_placeholders(sources, concurrency=4)]
+
+    results = loop.run_until_complete(collect())
+    assert [source.num for source, _ in results] == list(range(50))
+    assert [source.num for source, error in results if error is not None] == [3, 10, 17, 24, 31, 38, 45]
+    assert FakeSource.peak == 4
+
+def test_closing_cancels_outstanding_lookups():
+    FakeSource.running = FakeSource.peak = 0
+    loop = asyncio.get_event_loop()
+    sources = [FakeSource(num) for num in range(50)]
+
+    async def take_two():
+        resolved = make_source_init(loop).resolve_placeholders(sources, concurrency=4)
+        taken = [await resolved.__anext__(), await resolved.__anext__()]
+        await resolved.aclose()
+        await asyncio.sleep(0.05)
+        return taken
+
+    taken = loop.run_until_complete(take_two())
+    assert [source.num for source, _ in taken] == [0, 1]
+    assert FakeSource.running == 0
@@ -0,0 +1,77 @@
+import os
+import asyncio
+
+import ytdl
+
+class FakeCache:
+
+    def __init__(self):
+        self.added = []
+
+    def path(self, name: str):
+        return os.path.join("audio_cache", name)
+
+    def lookup(self, name: str):
+        return None
+
+    def add(self, name: str, **metadata):
+        self.added.append(name)
+
+def make_source(loop):
+    source = ytdl.YTDLSource(loop, FakeCache(), None)
+    job = ytdl.DownloadJob("search", source.audio_cache.path("youtube-abc.m4a"), loop)
+    job.future = loop.create_future()
+
+    def start_download(search: str, filename: str):
+        source.jobs[filename] = job
+        return job
+    source.start_download = start_download
+    return source, job
+
+def test_one_waiter_leaving_does_not_cancel_a_shared_download(make_data):
+    loop = asyncio.get_event_loop()
+    source, job = make_source(loop)
+    with open(source.audio_cache.path("youtube-abc.m4a"), 'wb') as f:
+        f.write(b"audio")
+
+    async def scenario():
+        first = loop.create_task(source.ready_download(make_data()))
+        second = loop.create_task(source.ready_download(make_data()))
+        await asyncio.sleep(0.01)
+        assert job.waiters == 2
+
+        first.cancel()
+        await asyncio.sleep(0.01)
+        assert not job.cancelled and job.waiters == 1
+
+        job.future.set_result(None)
+        return await second
+
+    data = loop.run_until_complete(scenario())
+    assert data.checksum is not None
+    assert job.waiters == 0 and not job.cancelled
+
+def test_last_waiter_leaving_cancels_the_download(make_data):
+    loop = asyncio.get_event_loop()
+    source, job = make_source(loop)
+
+    async def scenario():
+        waiter = loop.create_task(source.ready_download(make_data()))
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        await asyncio.sleep(0.01)
+
+    loop.run_until_complete(scenario())
+    assert job.cancelled
+
+def test_listeners_get_throttled_progress_on_the_loop():
+    loop = asyncio.get_event_loop()
+    job = ytdl.DownloadJob("search", "youtube-abc.m4a", loop)
+    heard = []
+    job.add_listener(lambda downloaded, total: heard.append((downloaded, total)))
+
+    job.progress_hook({"status" : "downloading", "downloaded_bytes" : 1, "total_bytes" : 10})
+    job.progress_hook({"status" : "downloading", "downloaded_bytes" : 2, "total_bytes" : 10})
+    job.progress_hook({"status" : "finished", "downloaded_bytes" : 10, "total_bytes" : 10})
+    loop.run_until_complete(asyncio.sleep(0))
+    assert heard == [(1, 10), (10, 10)]
@@ -0,0 +1,57 @@
+import sys
+import socket
+import asyncio
+import sqlite3
+import urllib.error
+
+import pytest
+import youtube_dl
+
+import cache
+import ytdl
+
+class FailingExtractor:
+    """Fails the way YoutubeDL reports errors, wrapping what went wrong in a DownloadError"""
+
+    def __init__(self, error: Exception):
+        self.error = error
+
+    def extract_info(self, search: str, **kwargs):
+        try:
+            raise self.error
+        except Exception:
+            raise youtube_dl.utils.DownloadError(f"ERROR: {self.error}", sys.exc_info())
+
+def make_source(monkeypatch, error: Exception):
+    loop = asyncio.get_event_loop()
+    db = sqlite3.connect(":memory:")
+    db.row_factory = sqlite3.Row
+    metadata = cache.MetadataCache(db, ttl=3600, negative_ttl=60)
+    source = ytdl.YTDLSource(loop, None, metadata)
+    # Extractions run on executor threads, so the per thread instance is replaced on the class
+    extractor = FailingExtractor(error)
+    monkeypatch.setattr(ytdl.YTDLSource, "ytdl", property(lambda self: extractor))
+    return source, loop
+
+def test_unavailable_video_is_cached_as_a_miss(monkeypatch):
+    source, loop = make_source(monkeypatch, youtube_dl.utils.ExtractorError("Video unavailable", expected=True))
+    with pytest.raises(ytdl.YTDLError, match="Video unavailable"):
+        loop.run_until_complete(source.create_source("https://www.youtube.com/watch?v=aaaaaaaaaaa"))
+    for _ in range(2):
+        with pytest.raises(ytdl.YTDLError):
+            loop.run_until_complete(source.create_source("https://www.youtube.com/watch?v=aaaaaaaaaaa"))
+    assert source.extract_calls == 1
+    assert source.metadata.negative_hits == 2
+
+@pytest.mark.parametrize("error", [
+    urllib.error.URLError("Name or service not known"),
+    socket.timeout("timed out"),
+    urllib.error.HTTPError("https://www.youtube.com", 503, "Service Unavailable", {}, None)
+])
+def test_network_errors_are_not_cached(monkeypatch, error):
+    source, loop = make_source(monkeypatch, error)
+    for _ in range(2):
+        with pytest.raises(youtube_dl.utils.DownloadError):
+            loop.run_until_complete(source.create_source("https://www.youtube.com/watch?v=aaaaaaaaaaa"))
+    assert source.extract_calls == 2
+    assert source.metadata.negative_hits == 0
@@ -0,0 +1,114 @@
+import os
+import asyncio
+import hashlib
+import functools
+from io import BytesIO
+from collections import OrderedDict
+
+from PIL import Image
+
+import cache
+from main import WORKER_ID
+
+def make_thumbnail(picture: bytes, size: int):
+    """Downscales cover art to fit within size x size and recompresses it as JPEG"""
+    with Image.open(BytesIO(picture)) as im:
+        # Lets JPEG art decode straight at a reduced scale instead of at full size
+        im.draft('RGB', (size, size))
+        im = im.convert('RGB')
+        im.thumbnail((size, size))
+        output = BytesIO()
+        im.save(output, format="JPEG", quality=85, optimize=True)
+    return output.getvalue()
+
+def write_thumbnail(directory: str, picture: bytes, size: int):
+    thumbnail = make_thumbnail(picture, size)
+    name = hashlib.md5(thumbnail).hexdigest() + ".jpg"
+    path = f"{directory}\\{name}"
+    if not os.path.isfile(path):
+        with open(f"{path}.{WORKER_ID}.tmp", 'wb') as f:
+            f.write(thumbnail)
+        os.replace(f"{path}.{WORKER_ID}.tmp", path)
+    return name, thumbnail
+
+class ThumbnailCache:
+    """Embed sized cover art stored in the image cache under a content hash, so tracks sharing art share a file.
+    Tracks are mapped to their thumbnail in the image cache index and recently used thumbnails are kept in memory.
+    """
+
+    def __init__(self, image_cache: cache.CacheManager, size: int, memory_bytes: int, loop: asyncio.BaseEventLoop = None):
+
+        self.image_cache = image_cache
+        self.size = size
+        self.memory_bytes = memory_bytes
+        self.loop = loop or asyncio.get_event_loop()
+
+        self.memory = OrderedDict()
+        self.total_bytes = 0
+
+        with self.image_cache.db:
+            self.image_cache.db.execute("""
+                CREATE TABLE IF NOT EXISTS thumbnails (
+                    source TEXT PRIMARY KEY,
+                    name TEXT NOT NULL
+                )
+            """)
+
+    def lookup(self, source: str):
+        """Returns the thumbnail file name of a track, or None if it has none cached"""
+        row = self.image_cache.db.execute("SELECT name FROM thumbnails WHERE source = ?", (source,)).fetchone()
+        if row is None:
+            return None
+        if row['name'] not in self.memory and self.image_cache.lookup(row['name']) is None:
+            return None
+        return row['name']
+
+    async def add(self, source: str, picture: bytes):
+        """Stores the thumbnail of a track's cover art and returns its file name, or None if the art can't be decoded"""
+        partial = functools.partial(write_thumbnail, self.image_cache.directory, picture, self.size)
+        try:
+            name, thumbnail = await self.loop.run_in_executor(None, partial)
+        except Exception:
+            return None
+
+        self.image_cache.add(name)
+        with self.image_cache.db:
+            self.image_cache.db.execute("INSERT OR REPLACE INTO thumbnails (source, name) VALUES (?, ?)", (source, name))
+        self.remember(name, thumbnail)
+        return name
+
+    async def load(self, name: str):
+        """Reads a thumbnail into memory ahead of time so get() doesn't have to touch the disk"""
+        if name in self.memory:
+            self.memory.move_to_end(name)
+            return
+        try:
+            thumbnail = await self.loop.run_in_executor(None, self.read, name)
+        except OSError:
+            return
+        self.remember(name, thumbnail)
+
+    def get(self, name: str):
+        """Returns the bytes of a thumbnail, from memory when it is hot"""
+        thumbnail = self.memory.get(name)
+        if thumbnail is not None:
+            self.memory.move_to_end(name)
+            return thumbnail
+
+        thumbnail = self.read(name)
+        self.remember(name, thumbnail)
+        return thumbnail
+
+    def read(self, name: str):
+        with open(self.image_cache.path(name), 'rb') as f:
+            return f.read()
+
+    def remember(self, name: str, thumbnail: bytes):
+        if name in self.memory:
+            self.total_bytes -= len(self.memory.pop(name))
+        self.memory[name] = thumbnail
+        self.total_bytes += len(thumbnail)
+
+        while self.total_bytes > self.memory_bytes and len(self.memory) > 1:
+            _, evicted = self.memory.popitem(last=False)
+            self.total_bytes -= len(evicted)
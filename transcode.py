@@ -0,0 +1,37 @@
+import os
+import asyncio
+
+from main import INFO, WORKER_ID
+
+def opus_filename(filename: str):
+    return filename.rsplit(".", 1)[0] + ".opus"
+
+async def to_opus(source: str, destination: str, bitrate: int = 128):
+    """Transcodes an audio file to Ogg/Opus so playback can pass its packets straight to discord.
+    Returns whether it succeeded, the destination only appears once the file is complete.
+    """
+
+    part_file = f"{destination}.{WORKER_ID}.part"
+    try:
+        process = await asyncio.create_subprocess_exec(
+            'ffmpeg', '-y', '-loglevel', 'error',
+            '-i', source,
+            '-vn', '-map_metadata', '-1',
+            '-c:a', 'libopus', '-b:a', f'{bitrate}k', '-ar', '48000', '-ac', '2',
+            '-f', 'ogg', part_file,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE
+        )
+    except OSError as e:
+        INFO(f"Failed to start ffmpeg: {e}")
+        return False
+    _, stderr = await process.communicate()
+
+    if process.returncode != 0:
+        INFO(f"Failed to transcode {source}: {stderr.decode(errors='replace').strip()}")
+        if os.path.isfile(part_file):
+            os.remove(part_file)
+        return False
+
+    os.replace(part_file, destination)
+    return True
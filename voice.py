@@ -1,13 +1,21 @@
 import asyncio
+import functools
 import itertools
 import random
+import shutil
+import time
+from collections import OrderedDict, deque, namedtuple
+from io import BytesIO
 
 import discord
 from async_timeout import timeout
 from discord.ext import commands
 
 import SourceDL
-from main import load_file, INFO
+import ffmpeg_pool
+from autoplay import AutoPlayer
+from blocklist import BlockList
+from main import INFO, config
 
 colors = {
   'DEFAULT': 0x000000,
@@ -53,13 +61,17 @@ class Song:
     def create_embed(self):
         thumbnail_file = None
         color_list = [c for c in colors.values()]
+        duration = self.source.data.duration
+        if isinstance(duration, int):
+            # Still downloading, so the duration hasn't been formatted yet
+            duration = SourceDL.MusicInfo.parse_duration(duration)
         embed = (
             discord.Embed(
                 title='Now playing',
                 description=f'```css\n{self.source.data.title}\n```',
                 color=random.choice(color_list)
             )
-            .add_field(name='Duration', value=self.source.data.duration)
+            .add_field(name='Duration', value=duration)
             .add_field(name='Requested by', value=self.requester.mention)
         )
         if self.source.data.artist != "Unknown":
@@ -71,17 +83,22 @@ class Song:
 
         if self.source.data.thumbnail:
             embed.set_thumbnail(url=self.source.data.thumbnail)
-        else:
-            thumbnail_file = discord.File("image_cache\\" + str(self.source.data.title) + ".jpg", filename="image.jpg")
-            embed.set_thumbnail(url="attachment://image.jpg")
+        elif self.source.data.image_filename:
+            try:
+                thumbnail = self.source.backends.thumbnails.get(self.source.data.image_filename)
+            except OSError:
+                thumbnail = None
+            if thumbnail:
+                thumbnail_file = discord.File(BytesIO(thumbnail), filename="image.jpg")
+                embed.set_thumbnail(url="attachment://image.jpg")
         return embed, thumbnail_file
 
 class SongQueue(asyncio.Queue):
+    def _init(self, maxsize):
+        self._queue = BlockList()
+
     def __getitem__(self, item):
-        if isinstance(item, slice):
-            return list(itertools.islice(self._queue, item.start, item.stop, item.step))
-        else:
-            return self._queue[item]
+        return self._queue[item]
 
     def __iter__(self):
         return iter(self._queue)
@@ -89,29 +106,80 @@ class SongQueue(asyncio.Queue):
     def __len__(self):
         return self.qsize()
 
+    def page(self, start: int, end: int):
+        return self._queue.page(start, end)
+
     def clear(self):
         self._queue.clear()
 
     def shuffle(self):
-        random.shuffle(self._queue)
+        self._queue.shuffle()
 
     def remove(self, index: int):
         del self._queue[index]
 
+    def move(self, index: int, new_index: int):
+        self._queue.move(index, new_index)
+
+HistoryEntry = namedtuple('HistoryEntry', ('title', 'webpage_url'))
+
+class SongHistory:
+    """Recently played tracks, newest first, keeping only the title and url of each.
+    Replaying a track moves it to the front instead of adding it twice and the oldest are dropped past max_size.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+
+    def add(self, track_id, title: str, webpage_url: str):
+        self._entries.pop(track_id, None)
+        self._entries[track_id] = HistoryEntry(title, webpage_url)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def page(self, start: int, end: int):
+        return list(itertools.islice(reversed(self._entries.values()), start, end))
+
+    def __iter__(self):
+        return reversed(self._entries.values())
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        self._entries.clear()
 
 class VoiceState:
-    def __init__(self, bot: commands.Bot, ctx: commands.Context):
+    def __init__(self, bot: commands.Bot, ctx: commands.Context, backends: SourceDL.Backends):
         self.bot = bot
         self._ctx = ctx
+        self.backends = backends
 
         self.current = None
         self.voice = None
         self.next = asyncio.Event()
         self.songs = SongQueue()
-        self.song_history = []
-        self.autoplaylist = []
+        self.song_history = SongHistory(config.get('history_size', 100))
+        self.autoplayer = AutoPlayer(ctx, backends, bot.loop)
         self.exists = True
         self.previous_message = None
+        self.lookahead_size = config.get('lookahead', 3)
+        self.prefetch_size = config.get('prefetch', 2)
+        self.prefetch_min_free = config.get('prefetch_min_free_mb', 1024) * 1024 * 1024
+        self.prefetching = {}
+        self.pinned = {}
+        self.streaming = config.get('streaming', True)
+        self.stream_wait = config.get('stream_wait', 1.0)
+        self.upcoming = None
+        self.track_ended = None
+        self.transitions = deque(maxlen=100)
+        self.announce_lock = asyncio.Lock()
+        self.playlist_concurrency = config.get('playlist_concurrency', 4)
+        # Only the start of a playlist is resolved up front, the rest waits for the lookahead like any track
+        self.playlist_resolve_window = config.get('playlist_resolve_window', 50)
+        # Playlists that were enqueued and are still being resolved, cancelled by stop
+        self.imports = set()
 
         self._loop = False
         self._autoplay = True
@@ -156,82 +224,266 @@ class VoiceState:
             self.next.clear()
             self.now = None
 
-            if self.previous_message:
-                await self.previous_message.delete()
-                self.previous_message = None
-
             if self._loop:
                 if self.current:
                     await self.songs.put(self.current)
 
-            try:
-                async with timeout(5):
-                    self.current = await self.songs.get()
-            except asyncio.TimeoutError:
-                self.current = None
-                if self._autoplay:
-                    if not self.voice:
-                        self.bot.loop.create_task(self.stop())
-                        self.exists = False
-                        return
-                    INFO("Fetching autoplay List")
-                    if not self.autoplaylist:
-                        self.autoplaylist = list(load_file("autoplaylist.txt"))
-                    while self.autoplaylist:
-                        random_link = random.choice(self.autoplaylist)
-                        INFO(f"Trying {random_link} from autoplaylist")
-                        self.autoplaylist.remove(random_link)
-                        song_url, source_type, playlist = SourceDL.get_type(random_link)
-                        source_init = SourceDL.Source(self._ctx, source_type=source_type, loop=self.bot.loop)
-                        if playlist:
-                            playlist_info = await source_init.get_playlist_info(song_url)
-                            INFO(f"Adding {playlist_info.song_num} songs from {random_link}")
-                            try:
-                                sources = await source_init.get_playlist(song_url)
-                            except SourceDL.SourceError:
-                                continue
-                            else:
-                                if source_type == "GDrive":
-                                    for num, each_source in enumerate(sources):
-                                        sources[num] = f"https://drive.google.com/file/d/{each_source}/view"
-                            self.autoplaylist = sources
-                            continue
-                        else:
-                            try:
-                                source = await source_init.create_source(song_url)
-                            except SourceDL.SourceError:
-                                pass
-                            else:
-                                song = Song(source)
-                                await self._ctx.voice_state.songs.put(song)
+            if self._autoplay and self.voice and self.songs.empty():
+                self.current = await self.next_autoplay()
+            else:
+                try:
+                    async with timeout(5):
                         self.current = await self.songs.get()
-                        if self.current:
-                            break
-                        continue
-                    if not self.current:
-                        self.bot.loop.create_task(self.stop())
-                        self.exists = False
-                        return
-                else:
-                    self.bot.loop.create_task(self.stop())
-                    self.exists = False
-                    return
-            for each_song in self.song_history:
-                if self.current.source.data.title == each_song.source.data.title:
-                    self.song_history.remove(each_song)
-            self.song_history.insert(0, self.current)
+                except asyncio.TimeoutError:
+                    self.current = None
+                    if self._autoplay and self.voice:
+                        self.current = await self.next_autoplay()
+
+            if not self.current:
+                self.bot.loop.create_task(self.stop())
+                self.exists = False
+                return
+            upcoming = self.take_upcoming(self.current)
+            # Start the current track before the prefetch window moves past it
+            self.current.source.start_download()
+            self.queue_changed()
+            if self._autoplay and self.songs.empty():
+                # Get the autoplay track ready while this one plays
+                self.autoplayer.prepare()
+            if upcoming is not None:
+                source, embed, thumbnail = upcoming
+            else:
+                try:
+                    source = await self.create_audio_source(self.current.source)
+                except Exception as e:
+                    INFO(f"Skipping {self.current.source.data.title}: {e}")
+                    self.current = None
+                    continue
+                embed = thumbnail = None
+            self.song_history.add(
+                (self.current.source.source_type, self.current.source.data.search),
+                self.current.source.data.title,
+                self.current.source.data.webpage_url
+            )
             self.current.source.volume = self._volume
-            await self.current.source.ready_download()
-            with open(f"audio_cache\\{self.current.source.data.expected_filename}", 'rb') as f:
-                source = discord.FFmpegPCMAudio(f, pipe=True)
-            self.voice.play(source, after=self.play_next_song)
-            #await self.current.source.bot.change_presence(activity=discord.Game(f"{self.current.source.title}"))
-            embed, thumbnail = self.current.create_embed()
+            playing_file = self.current.source.data.expected_filename
+            self.backends.audio_cache.pin(playing_file)
+            try:
+                self.voice.play(source, after=self.play_next_song)
+                self.record_transition(prepared=upcoming is not None)
+                #await self.current.source.bot.change_presence(activity=discord.Game(f"{self.current.source.title}"))
+                if embed is None:
+                    embed, thumbnail = self.current.create_embed()
+                self.bot.loop.create_task(self.announce(self.current, embed, thumbnail))
+                await self.next.wait()
+            finally:
+                self.backends.audio_cache.unpin(playing_file)
+
+    async def announce(self, song: Song, embed: discord.Embed, thumbnail: discord.File = None):
+        """Replaces the now playing message, this runs alongside playback so it never holds up the track"""
+        async with self.announce_lock:
+            if self.previous_message:
+                try:
+                    await self.previous_message.delete()
+                except discord.HTTPException:
+                    pass
+                self.previous_message = None
+
             if thumbnail:
-                self.previous_message = await self.current.source.channel.send(embed=embed, file=thumbnail)
+                self.previous_message = await song.source.channel.send(embed=embed, file=thumbnail)
+            else:
+                self.previous_message = await song.source.channel.send(embed=embed)
+
+    def record_transition(self, prepared: bool):
+        """Records the silence between the end of the previous track and the start of this one"""
+        if self.track_ended is None:
+            return
+        elapsed = time.perf_counter() - self.track_ended
+        self.track_ended = None
+        self.transitions.append(elapsed)
+        INFO(f"Track transition took {elapsed * 1000:.0f} ms ({'prepared' if prepared else 'not prepared'})")
+
+    def prepare_upcoming(self):
+        """Builds the audio source and embed of the next queued song once prefetch has downloaded it,
+        so the switch at the end of the current song is just voice.play().
+        """
+        if self.upcoming is not None and (self.songs.empty() or self.songs[0] is not self.upcoming[0]):
+            self.discard_upcoming()
+        if self.upcoming is not None or self.songs.empty():
+            return
+
+        # Downloading is left to prefetch so its slots, disk budget and window size still apply
+        song = self.songs[0]
+        if not song.source.downloaded:
+            return
+        try:
+            source = self.cached_audio_source(song.source)
+            embed, thumbnail = song.create_embed()
+        except Exception as e:
+            INFO(f"Couldn't prepare the next song: {e}")
+            return
+        self.upcoming = (song, source, embed, thumbnail, song.source.data.expected_filename)
+        self.backends.audio_cache.pin(song.source.data.expected_filename)
+
+    def take_upcoming(self, song: Song):
+        """Returns the prepared (source, embed, thumbnail) for song, or None if it isn't the one that was prepared"""
+        if self.upcoming is None or self.upcoming[0] is not song:
+            return None
+        _, source, embed, thumbnail, filename = self.upcoming
+        self.upcoming = None
+        self.backends.audio_cache.unpin(filename)
+        return source, embed, thumbnail
+
+    def discard_upcoming(self):
+        if self.upcoming is not None:
+            _, source, _, _, filename = self.upcoming
+            self.upcoming = None
+            source.cleanup()
+            self.backends.audio_cache.unpin(filename)
+
+    async def next_autoplay(self):
+        """Returns whichever is ready first, a newly queued song or the prepared autoplay track"""
+        INFO("Fetching autoplay track")
+        queued = self.bot.loop.create_task(self.songs.get())
+        prepared = self.autoplayer.prepare()
+        await asyncio.wait({queued, prepared}, return_when=asyncio.FIRST_COMPLETED)
+        if queued.done():
+            return queued.result()
+        queued.cancel()
+
+        source = await self.autoplayer.take()
+        return Song(source) if source else None
+
+    async def create_audio_source(self, source: SourceDL.MusicInfo):
+        """Plays from the cache, or straight from the stream if the download doesn't finish within stream_wait seconds.
+        The download carries on in the background either way so the next play is a cache hit.
+        """
+        download = source.start_download()
+        if self.streaming and download is not None:
+            await source.resolve()
+            done, _ = await asyncio.wait({download}, timeout=self.stream_wait)
+            if not done:
+                stream = await source.stream_source()
+                if stream is not None:
+                    stream_input, before_options = stream
+                    INFO(f"Streaming {source.data.title} while it downloads")
+                    if isinstance(stream_input, str):
+                        return discord.FFmpegOpusAudio(stream_input, before_options=before_options, options='-vn')
+                    return ffmpeg_pool.PipedOpusAudio(stream_input, self.bot.loop, options='-vn')
+
+        await source.ready_download()
+        return self.cached_audio_source(source)
+
+    def cached_audio_source(self, source: SourceDL.MusicInfo):
+        playing_file = self.backends.audio_cache.path(source.data.expected_filename)
+        if playing_file.endswith(".opus"):
+            # Already opus, so ffmpeg only has to demux it, preferably in a worker that is already running
+            pooled = self.backends.ffmpeg_pool.acquire(playing_file)
+            if pooled is not None:
+                return pooled
+            return discord.FFmpegOpusAudio(playing_file, codec='opus')
+        return discord.FFmpegOpusAudio(playing_file)
+
+    def queue_changed(self):
+        """Called whenever songs are added, removed or reordered"""
+        self.lookahead()
+        self.prefetch()
+        self.prepare_upcoming()
+
+    def lookahead(self):
+        """Starts resolving the next few queued tracks so they are ready by the time they play"""
+        for song in self.songs[:self.lookahead_size]:
+            song.source.start_resolve()
+
+    def prefetch(self):
+        """Downloads the next few queued tracks in the background.
+        Prefetches for tracks that left the window are cancelled unless they already started downloading.
+        """
+        wanted = [song.source for song in self.songs[:self.prefetch_size]]
+        for source in list(self.prefetching):
+            if source not in wanted:
+                self.prefetching.pop(source).cancel()
+
+        # Downloaded tracks in the window are pinned so cache eviction can't remove them before they play
+        for source in list(self.pinned):
+            if source not in wanted:
+                self.backends.audio_cache.unpin(self.pinned.pop(source))
+
+        for source in wanted:
+            if source.downloaded and source not in self.pinned:
+                self.pinned[source] = source.data.expected_filename
+                self.backends.audio_cache.pin(source.data.expected_filename)
+            if source not in self.prefetching and not source.downloaded:
+                task = self.bot.loop.create_task(self.prefetch_source(source))
+                task.add_done_callback(functools.partial(self.prefetch_done, source))
+                self.prefetching[source] = task
+
+    def prefetch_done(self, source: SourceDL.MusicInfo, task: asyncio.Task):
+        if self.prefetching.get(source) is task:
+            del self.prefetching[source]
+
+    async def prefetch_source(self, source: SourceDL.MusicInfo):
+        async with self.backends.prefetch_slots:
+            if source.downloaded:
+                # Finished by the player or another guild while this waited for a slot, it only needs pinning
+                self.prefetch()
+                self.prepare_upcoming()
+                return
+            if shutil.disk_usage(self.backends.audio_cache.directory).free < self.prefetch_min_free:
+                return
+            try:
+                # Shielded so that leaving the window never leaves a half written file behind
+                await asyncio.shield(source.start_download())
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                INFO(f"Failed to prefetch {source.data.title}: {e}")
             else:
-                self.previous_message = await self.current.source.channel.send(embed=embed)
-            await self.next.wait()
+                self.prefetch()
+                self.prepare_upcoming()
+
+    def start_import(self, source_init: SourceDL.Source, sources: list, message: discord.Message, embed: discord.Embed):
+        """Resolves the first tracks of a playlist that was just enqueued ahead of the lookahead, reporting progress on message"""
+        sources = sources[:self.playlist_resolve_window]
+        task = self.bot.loop.create_task(self.resolve_import(source_init, sources, message, embed))
+        self.imports.add(task)
+        task.add_done_callback(self.imports.discard)
+
+    async def resolve_import(self, source_init: SourceDL.Source, sources: list, message: discord.Message, embed: discord.Embed):
+        description = embed.description
+        resolved = source_init.resolve_placeholders(sources, concurrency=self.playlist_concurrency)
+        done = failed = 0
+        last_progress = time.monotonic()
+        try:
+            async for source, error in resolved:
+                done += 1
+                if error is not None:
+                    failed += 1
+                    INFO(f"Couldn't resolve {source.data.search}: {error}")
+
+                if time.monotonic() - last_progress > 2:
+                    last_progress = time.monotonic()
+                    embed.description = f'{description}\nResolved {done}/{len(sources)}'
+                    await self.edit_import(message, embed)
+
+            embed.description = description
+            if failed:
+                embed.description += f'\n{failed} of the first {len(sources)} couldn\'t be found and will be skipped'
+            await self.edit_import(message, embed)
+        finally:
+            await resolved.aclose()
+            await message.delete(delay=10)
+
+    @staticmethod
+    async def edit_import(message: discord.Message, embed: discord.Embed):
+        try:
+            await message.edit(embed=embed)
+        except discord.HTTPException:
+            pass
+
+    def cancel_imports(self):
+        for task in list(self.imports):
+            task.cancel()
 
     def play_next_song(self, error=None):
         if error:
@@ -244,7 +496,9 @@ class VoiceState:
             if not self.voice:
                 raise VoiceError(str(error))
 
-        self.next.set()
+        # Called from the audio thread, so the player task has to be woken up through the loop
+        self.track_ended = time.perf_counter()
+        self.bot.loop.call_soon_threadsafe(self.next.set)
 
     def skip(self):
         self.skip_votes.clear()
@@ -253,7 +507,10 @@ class VoiceState:
             self.voice.stop()
 
     async def stop(self):
+        self.cancel_imports()
         self.songs.clear()
+        self.queue_changed()
+        self.autoplayer.stop()
 
         if self.voice:
             await self.voice.disconnect()
@@ -1,11 +1,17 @@
 import os
+import re
+import time
 import asyncio
 import functools
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import youtube_dl
 from pathvalidate import sanitize_filename
 
-from main import INFO
+import cache
+from main import INFO, WORKER_ID, config
 
 youtube_dl.utils.bug_reports_message = lambda: ''
 YTDL_OPTIONS = {
@@ -24,68 +30,210 @@ YTDL_OPTIONS = {
     'source_address': '0.0.0.0',
 }
 
+STREAM_URL_TTL = 60 * 60
+# youtube_dl calls the progress hook for every block, listeners hear about it at most this often
+LISTENER_INTERVAL = 0.5
+PROCESSED_INFO_LIMIT = 64
+
 class YTDLError(Exception):
     pass
 
+class DownloadJob:
+    """A download running on the YTDLSource download pool.
+    Progress from youtube_dl is kept on the job and forwarded to listeners on the event loop.
+    """
+
+    def __init__(self, search: str, path: str, loop: asyncio.BaseEventLoop, info: dict = None):
+
+        self.search = search
+        # Where the finished file goes in the audio cache
+        self.path = path
+        self.loop = loop
+        self.info = info
+        self.progress = {}
+        self.listeners = []
+        self.last_reported = 0
+        # Number of ready_download calls awaiting this job, it is only cancelled once none are left
+        self.waiters = 0
+        self.cancelled = False
+        self.future = None
+
+    def add_listener(self, listener):
+        """Calls listener(downloaded_bytes, total_bytes) on the event loop as the download progresses"""
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def progress_hook(self, progress: dict):
+        # Raising from the hook is the only way to stop youtube_dl mid download, it leaves just the .part file
+        if self.cancelled:
+            raise YTDLError('Download of `{}` was cancelled'.format(self.search))
+
+        self.progress = progress
+        now = time.monotonic()
+        if progress.get('status') != 'finished' and now - self.last_reported < LISTENER_INTERVAL:
+            return
+        self.last_reported = now
+
+        downloaded = progress.get('downloaded_bytes')
+        total = progress.get('total_bytes') or progress.get('total_bytes_estimate')
+        for listener in list(self.listeners):
+            self.loop.call_soon_threadsafe(listener, downloaded, total)
+
+    def run(self):
+        download_info = YTDL_OPTIONS.copy()
+        # Downloaded under a name of this process so other processes sharing the cache never write the same file
+        temp_file = f"{self.path}.{WORKER_ID}.tmp"
+        download_info['outtmpl'] = temp_file
+        download_info['progress_hooks'] = [self.progress_hook]
+        with youtube_dl.YoutubeDL(download_info) as ydl:
+            if self.info is not None:
+                # Already extracted, this only picks the format again and downloads it
+                ydl.process_ie_result(self.info, download=True)
+            else:
+                ydl.extract_info(self.search)
+        os.replace(temp_file, self.path)
+
+    def cancel(self):
+        self.cancelled = True
+
 class YTDLSource:
 
-    def __init__(self, loop: asyncio.BaseEventLoop = None):
+    def __init__(
+        self,
+        loop: asyncio.BaseEventLoop = None,
+        audio_cache: cache.CacheManager = None,
+        metadata: cache.MetadataCache = None
+    ):
 
         self.FFMPEG_OPTIONS = {
             'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5',
             'options': '-vn',
         }
 
-        self.ytdl = youtube_dl.YoutubeDL(YTDL_OPTIONS)
+        self.local = threading.local()
         self.loop = loop
+        self.audio_cache = audio_cache
+        self.metadata = metadata
+
+        self.download_pool = ThreadPoolExecutor(
+            max_workers=config.get('download_workers', 2),
+            thread_name_prefix='ytdl-download'
+        )
+        self.download_timeout = config.get('download_timeout', 600)
+        self.jobs = {}
+
+        # Processed extractions waiting to be downloaded, keyed by expected_filename
+        self.processed = OrderedDict()
+        self.extract_calls = 0
+        self.extract_lock = threading.Lock()
+
+    @property
+    def ytdl(self):
+        # YoutubeDL keeps per-instance state, so every executor thread gets its own
+        ydl = getattr(self.local, 'ytdl', None)
+        if ydl is None:
+            ydl = youtube_dl.YoutubeDL(YTDL_OPTIONS)
+            self.local.ytdl = ydl
+        return ydl
+
+    def extract_info(self, search: str, **kwargs):
+        with self.extract_lock:
+            self.extract_calls += 1
+        try:
+            return self.ytdl.extract_info(search, **kwargs)
+        except youtube_dl.utils.DownloadError as e:
+            if self.is_transient(e):
+                # Could work on the next try, so it mustn't be remembered as a miss
+                raise
+            raise YTDLError('Couldn\'t fetch `{}`: {}'.format(search, e))
+
+    @staticmethod
+    def is_transient(error: youtube_dl.utils.DownloadError):
+        """Whether an extraction failed on the network rather than on what was looked up"""
+        cause = error.exc_info[1] if error.exc_info else None
+        if isinstance(cause, youtube_dl.utils.ExtractorError):
+            cause = cause.cause
+        if isinstance(cause, youtube_dl.compat.compat_HTTPError):
+            return cause.code == 429 or cause.code >= 500
+        return isinstance(cause, OSError)
+
+    @staticmethod
+    def get_video_id(search: str):
+        match = re.search(r'(?:youtube\.com/watch\?(?:.*&)?v=|youtu\.be/|youtube\.com/shorts/)([\w-]{11})', search)
+        if match:
+            return match.group(1)
+        if re.fullmatch(r'[\w-]{11}', search):
+            return search
+        return None
 
     async def create_source(self, search: str):
+        """Returns the track info for a search, answering from the metadata cache when possible"""
+
+        keys = [self.metadata.search_key(search)]
+        video_id = self.get_video_id(search)
+        if video_id:
+            keys.insert(0, self.metadata.id_key('youtube', video_id))
+
+        found, info, age = self.metadata.get(keys)
+        if found:
+            if info is None:
+                raise YTDLError('Couldn\'t find anything that matches `{}`'.format(search))
+            if age > STREAM_URL_TTL:
+                # Stream urls expire long before the rest of the info does
+                info['stream_url'] = None
+            return info
 
-        partial = functools.partial(self.ytdl.extract_info, search, download=False, process=False)
         try:
-            data = await self.loop.run_in_executor(None, partial)
-        except:
-            return
+            info = await self.extract_source(search)
+        except YTDLError:
+            self.metadata.put(keys)
+            raise
+
+        if info is not None:
+            keys.append(self.metadata.id_key(info['extractor'], info['video_id']))
+            self.metadata.put(keys, info)
+        return info
+
+    async def extract_source(self, search: str):
+        """Resolves a search with a single fully processed extraction.
+        Only results the extractor left unprocessed (no formats yet) get a second extraction on their page url.
+        The processed info is kept for ready_download so the download reuses the chosen format.
+        """
+
+        partial = functools.partial(self.extract_info, search, download=False)
+        data = await self.loop.run_in_executor(None, partial)
 
         if data is None:
             raise YTDLError('Couldn\'t find anything that matches `{}`'.format(search))
 
         if 'entries' not in data:
-            process_info = data
+            info = data
         else:
-            process_info = None
-            for entry in data['entries']:
-                if entry:
-                    process_info = entry
-                    break
-
-            if process_info is None:
+            info = next((entry for entry in data['entries'] if entry), None)
+            if info is None:
                 raise YTDLError('Couldn\'t find anything that matches `{}`'.format(search))
 
-        webpage_url = process_info['webpage_url']
-        partial = functools.partial(self.ytdl.extract_info, webpage_url, download=False)
-        processed_info = await self.loop.run_in_executor(None, partial)
-
-        if processed_info is None:
-            raise YTDLError('Couldn\'t fetch `{}`'.format(webpage_url))
-
-        if 'entries' not in processed_info:
-            info = processed_info
-        else:
-            info = None
-            while info is None:
-                try:
-                    info = processed_info['entries'].pop(0)
-                except IndexError:
-                    raise YTDLError('Couldn\'t retrieve any matches for `{}`'.format(webpage_url))
-
-        sorted_info = await self.sort_info(info, webpage_url)
+        if 'formats' not in info and 'url' not in info:
+            webpage_url = info.get('webpage_url') or info['url']
+            partial = functools.partial(self.extract_info, webpage_url, download=False)
+            info = await self.loop.run_in_executor(None, partial)
+            if info is None:
+                raise YTDLError('Couldn\'t fetch `{}`'.format(webpage_url))
+
+        sorted_info = await self.sort_info(info, info['webpage_url'])
+        self.processed[sorted_info['expected_filename']] = (time.time(), info)
+        while len(self.processed) > PROCESSED_INFO_LIMIT:
+            self.processed.popitem(last=False)
         return sorted_info
 
     @staticmethod
     async def sort_info(data: dict, search: str):
         name = sanitize_filename(data['title'])
-        expected_filename = name + ".mp3"
+        # extractor names like twitch:vod aren't valid in file names, their keys are plain words
+        expected_filename = sanitize_filename(f"{data['extractor_key']}-{data['id']}.{data['ext']}")
 
         thumbnail = data['thumbnail']
         duration = int(data['duration'])
@@ -98,53 +246,122 @@ class YTDLSource:
             "webpage_url" : data['webpage_url'],
             "duration" : duration,
             "thumbnail" : thumbnail,
-            "expected_filename" : expected_filename
+            "expected_filename" : expected_filename,
+            "image_filename" : None,
+            "checksum" : None,
+            "stream_url" : data.get('url'),
+            "extractor" : data['extractor'],
+            "video_id" : data['id']
+        }
+
+        return info
+
+    @staticmethod
+    def placeholder_info(search: str, name: str = None):
+
+        # Flat playlist entries only carry the video id
+        if re.fullmatch(r'[\w-]{11}', search):
+            webpage_url = f"https://www.youtube.com/watch?v={search}"
+        else:
+            webpage_url = search
+
+        info = {
+            "search" : search,
+            "artist" : "Unknown",
+            "uploader" : "Unknown",
+            "title" : name or search,
+            "webpage_url" : webpage_url,
+            "duration" : 0,
+            "thumbnail" : None,
+            "expected_filename" : None,
+            "image_filename" : None,
+            "checksum" : None,
+            "stream_url" : None
         }
 
         return info
 
-    async def ready_download(self, data: dict):
+    async def ready_download(self, data: dict, progress=None):
 
         INFO(f"Started downloading {data.title} from {data.search}")
-        if not os.path.isfile(f"audio_cache\\{data.expected_filename}"):
-            download_info = YTDL_OPTIONS.copy()
-            download_info['outtmpl'] = f"audio_cache\\{data.expected_filename}"
-            with youtube_dl.YoutubeDL(download_info) as ydl:
-                ydl.extract_info(data.search)
+        if not self.audio_cache.lookup(data.expected_filename):
+            job = self.start_download(data.search, data.expected_filename)
+            job.waiters += 1
+            if progress is not None:
+                job.add_listener(progress)
+            try:
+                await asyncio.wait_for(asyncio.shield(job.future), self.download_timeout)
+            except asyncio.TimeoutError:
+                raise YTDLError('Timed out downloading `{}`'.format(data.title))
+            finally:
+                job.waiters -= 1
+                if progress is not None:
+                    job.remove_listener(progress)
+                # Other guilds may still be waiting on the same file, one of them giving up doesn't stop it
+                if job.waiters == 0 and not job.future.done():
+                    job.cancel()
+            partial = functools.partial(cache.file_checksum, self.audio_cache.path(data.expected_filename))
+            data.checksum = await self.loop.run_in_executor(None, partial)
+            self.audio_cache.add(
+                data.expected_filename,
+                title=data.title,
+                artist=data.artist,
+                duration=data.duration,
+                checksum=data.checksum
+            )
         INFO(f"Downloaded {data.title}")
 
         return data
 
-    async def get_playlist(self, search: str):
+    def stream_source(self, data: dict):
+        if not data.stream_url:
+            return None
+        return data.stream_url, self.FFMPEG_OPTIONS['before_options']
 
-        partial = functools.partial(self.ytdl.extract_info, search, download=False, process=False)
+    def start_download(self, search: str, filename: str):
+        """Returns the running job for this file, starting one on the download pool if there is none"""
+        job = self.jobs.get(filename)
+        if job is None:
+            info = None
+            processed_time, processed_info = self.processed.pop(filename, (0, None))
+            if time.time() - processed_time < STREAM_URL_TTL:
+                info = processed_info
+            else:
+                with self.extract_lock:
+                    self.extract_calls += 1
+            job = DownloadJob(search, self.audio_cache.path(filename), self.loop, info=info)
+            job.future = self.loop.run_in_executor(self.download_pool, job.run)
+            job.future.add_done_callback(lambda _: self.jobs.pop(filename, None))
+            self.jobs[filename] = job
+        elif job.cancelled and not job.future.done():
+            # Wanted again before its thread noticed the cancellation
+            job.cancelled = False
+        return job
+
+    async def fetch_playlist(self, search: str):
+        """Extracts a playlist once, its entries are paged through in the executor rather than on the event loop"""
+
+        partial = functools.partial(self.extract_playlist, search)
         data = await self.loop.run_in_executor(None, partial)
 
         if data is None:
             raise YTDLError('Couldn\'t find anything that matches `{}`'.format(search))
 
-        sources = []
-        for entry in data['entries']:
-            sources.append(entry['url'])
-
-        return sources
-
-    async def get_playlist_info(self, search: str):
+        return data
 
-        partial = functools.partial(self.ytdl.extract_info, search, download=False, process=False)
-        data = await self.loop.run_in_executor(None, partial)
+    def extract_playlist(self, search: str):
 
+        data = self.extract_info(search, download=False, process=False)
         if data is None:
-            raise YTDLError('Couldn\'t find anything that matches `{}`'.format(search))
+            return None
 
-        video_entries = list(data['entries'])
-        info = {
-            "title" : data['name'],
-            "song_num" : len(video_entries)
+        entries = [{"id" : entry['url'], "name" : entry.get('title')} for entry in data['entries']]
+        return {
+            "title" : data.get('title') or data.get('name'),
+            "song_num" : len(entries),
+            "entries" : entries
         }
 
-        return info
-
 """
     @classmethod
     async def search_source(cls, bot: commands.Bot, ctx: commands.Context, search: str, *, loop: asyncio.BaseEventLoop = None):